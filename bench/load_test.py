@@ -0,0 +1,262 @@
+"""اختبار حمل لمسارات البث في sy.py مع خوادم بديلة محلية
+
+مثال:
+    python bench/load_test.py --users 1000 10000 --db sqlite --tg-latency 0.05 --tg-429 0.01
+    DATABASE_URL=postgres://... python bench/load_test.py --users 100000 --db postgres
+
+لكل عدد مشتركين يُطبع: زمن التنفيذ، عدد الرسائل، الرسائل/ثانية، ذروة الذاكرة،
+وتأخر حلقة الأحداث (الأقصى و p99).
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_servers import start_stub_servers
+
+BENCH_USER_ID_BASE = 9_000_000_000
+SCENARIOS = ("prayers", "static", "weather")
+
+
+class LoopLagMonitor:
+    """قياس تأخر حلقة الأحداث بمؤقت دوري"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - expected))
+
+    def start(self):
+        self.samples = []
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        samples = sorted(self.samples) or [0.0]
+        return {
+            "loop_lag_max_ms": samples[-1] * 1000,
+            "loop_lag_p99_ms": samples[min(len(samples) - 1, int(0.99 * len(samples)))] * 1000,
+        }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="اختبار حمل البث في sy.py")
+    parser.add_argument("--users", type=int, nargs="+", default=[1000], help="أعداد المشتركين المراد اختبارها")
+    parser.add_argument("--db", choices=("sqlite", "postgres"), default="sqlite")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="prayers,static,weather")
+    parser.add_argument("--tg-latency", type=float, default=0.02, help="تأخير Bot API بالثواني")
+    parser.add_argument("--tg-429", type=float, default=0.0, help="نسبة ردود 429 من Bot API")
+    parser.add_argument("--tg-500", type=float, default=0.0, help="نسبة ردود 500 من Bot API")
+    parser.add_argument("--tg-403", type=float, default=0.0, help="نسبة المستخدمين الذين حظروا البوت")
+    parser.add_argument("--api-latency", type=float, default=0.1, help="تأخير aladhan و wttr بالثواني")
+    parser.add_argument("--api-429", type=float, default=0.0)
+    parser.add_argument("--api-500", type=float, default=0.0)
+    parser.add_argument("--send-rate", type=float, default=None,
+                        help="تجاوز BROADCAST_GLOBAL_RATE (الافتراضي قيمة البيئة)")
+    parser.add_argument("--coalesce-window", type=float, default=None,
+                        help="تجاوز MESSAGE_COALESCE_WINDOW لدمج رسائل المستخدم المتقاربة")
+    parser.add_argument("--json", action="store_true", help="طباعة النتائج بصيغة JSON")
+    parser.add_argument("--verbose", action="store_true", help="إظهار سجلات البوت")
+    return parser.parse_args()
+
+
+def configure_environment(args):
+    """ضبط متغيرات البيئة قبل استيراد sy لأن إعداداته تُقرأ عند الاستيراد"""
+    if args.db == "sqlite":
+        os.environ.pop("DATABASE_URL", None)
+        os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="sy-bench-"), "bench.db")
+    elif not os.environ.get("DATABASE_URL"):
+        sys.exit("❌ يجب تحديد DATABASE_URL عند استخدام --db postgres")
+    if args.send_rate:
+        os.environ["BROADCAST_GLOBAL_RATE"] = str(args.send_rate)
+    if args.coalesce_window is not None:
+        os.environ["MESSAGE_COALESCE_WINDOW"] = str(args.coalesce_window)
+    os.environ.setdefault("TOKEN", "123456:bench")
+
+
+def seed_users(sy, count):
+    """إضافة مشتركين مميزين بمدن عشوائية"""
+    end_date = "2999-12-31"
+    rows = [
+        (BENCH_USER_ID_BASE + i, random.choice(list(sy.CITY_CODES.values())), end_date)
+        for i in range(count)
+    ]
+    placeholder = "%s" if sy.DATABASE_URL else "?"
+    with sy.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"DELETE FROM users WHERE user_id >= {placeholder}", (BENCH_USER_ID_BASE,))
+        cursor.executemany(
+            f"INSERT INTO users (user_id, is_premium, city_code, end_date) VALUES "
+            f"({placeholder}, 1, {placeholder}, {placeholder})",
+            rows
+        )
+        conn.commit()
+    sy.load_premium_index()
+
+
+def remove_users(sy):
+    placeholder = "%s" if sy.DATABASE_URL else "?"
+    with sy.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"DELETE FROM users WHERE user_id >= {placeholder}", (BENCH_USER_ID_BASE,))
+        conn.commit()
+
+
+async def telegram_stats(sy, port):
+    response = await sy.http_get(f"http://127.0.0.1:{port}/__stats", retries=0)
+    return response.json()
+
+
+def reset_broadcast_keys(sy):
+    """السماح بإعادة البث نفسه في التشغيلات المتتالية"""
+    with sy.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM outbox_broadcasts")
+        conn.commit()
+
+
+async def drain_outbox(sy):
+    """انتظار تسليم كل ما أُدرج في صندوق الصادر"""
+    while (await sy.run_db(sy.get_outbox_stats))["depth"]:
+        await asyncio.sleep(0.1)
+
+
+async def run_scenario(sy, application, scenario):
+    await sy.run_db(reset_broadcast_keys, sy)
+    if scenario == "prayers":
+        await sy.schedule_daily_prayer_notifications(application)
+        await asyncio.gather(*(
+            sy.send_city_prayer_notification(application, city_en, "الظهر")
+            for city_en in sy.SYRIAN_CITIES.values()
+        ))
+    elif scenario == "static":
+        await sy.send_static_content(application, sy.AZKAR_SABAH_LIST, "أذكار الصباح")
+    elif scenario == "weather":
+        sy._weather_cache.clear()
+        await sy.send_weather_reports(application)
+    await drain_outbox(sy)
+
+
+async def run(args, ports):
+    import sy
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    sy.BASE_PRAYER_API = f"http://127.0.0.1:{ports['aladhan']}" + sy.BASE_PRAYER_API.split("api.aladhan.com", 1)[1]
+    sy.BASE_PRAYER_CALENDAR_API = (
+        f"http://127.0.0.1:{ports['aladhan']}" + sy.BASE_PRAYER_CALENDAR_API.split("api.aladhan.com", 1)[1]
+    )
+    sy.BASE_WEATHER_API = f"http://127.0.0.1:{ports['wttr']}/" + sy.BASE_WEATHER_API.split("wttr.in/", 1)[1]
+
+    sy.init_db_pool()
+    sy.setup_db()
+    application = (
+        sy.Application.builder()
+        .token(sy.TOKEN)
+        .base_url(f"http://127.0.0.1:{ports['telegram']}/bot")
+        .connection_pool_size(sy.BROADCAST_CONCURRENCY)
+        .pool_timeout(30)
+        .build()
+    )
+    await application.initialize()
+    await sy.start_http_client()
+    sy.start_db_executor()
+    scheduler = AsyncIOScheduler(timezone="Asia/Damascus")
+    application.bot_data["scheduler"] = scheduler
+    sy.start_outbox_worker(application)
+
+    scenarios = [s for s in args.scenarios.split(",") if s]
+    results = []
+    try:
+        for count in args.users:
+            seeded = time.monotonic()
+            await sy.run_db(seed_users, sy, count)
+            seed_elapsed = time.monotonic() - seeded
+            for scenario in scenarios:
+                monitor = LoopLagMonitor()
+                before = await telegram_stats(sy, ports["telegram"])
+                monitor.start()
+                started = time.monotonic()
+                await run_scenario(sy, application, scenario)
+                elapsed = time.monotonic() - started
+                lag = await monitor.stop()
+                after = await telegram_stats(sy, ports["telegram"])
+                messages = after.get("sendMessage", 0) - before.get("sendMessage", 0)
+                results.append({
+                    "users": count,
+                    "db": args.db,
+                    "scenario": scenario,
+                    "seed_s": seed_elapsed,
+                    "wall_s": elapsed,
+                    "messages": messages,
+                    "msgs_per_s": messages / elapsed if elapsed > 0 else 0,
+                    "http_429": after.get("injected_429", 0) - before.get("injected_429", 0),
+                    "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                    **lag,
+                })
+                scheduler.remove_all_jobs()
+    finally:
+        await sy.stop_outbox_worker()
+        if args.db == "postgres":
+            await sy.run_db(remove_users, sy)
+        await application.shutdown()
+        await sy.close_http_client()
+        sy.shutdown_db_executor()
+        sy.close_db_pool()
+    return results
+
+
+def print_results(results):
+    header = f"{'users':>8} {'scenario':<9} {'wall s':>8} {'msgs':>8} {'msg/s':>8} {'rss MB':>8} {'lag max':>8} {'lag p99':>8}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['users']:>8} {r['scenario']:<9} {r['wall_s']:>8.2f} {r['messages']:>8} "
+            f"{r['msgs_per_s']:>8.1f} {r['peak_rss_mb']:>8.1f} "
+            f"{r['loop_lag_max_ms']:>7.1f}ms {r['loop_lag_p99_ms']:>6.1f}ms"
+        )
+
+
+def main():
+    args = parse_args()
+    # تشغيل الخوادم البديلة قبل استيراد sy حتى لا ترث العملية الفرعية حالته
+    stub_process, ports = start_stub_servers({
+        "telegram": {"latency": args.tg_latency, "rate_429": args.tg_429,
+                     "rate_500": args.tg_500, "rate_403": args.tg_403},
+        "aladhan": {"latency": args.api_latency, "rate_429": args.api_429, "rate_500": args.api_500},
+        "wttr": {"latency": args.api_latency, "rate_429": args.api_429, "rate_500": args.api_500},
+    })
+    configure_environment(args)
+    try:
+        results = asyncio.run(run(args, ports))
+    finally:
+        stub_process.terminate()
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""مقارنة أداء SQLite: اتصال لكل استدعاء مقابل اتصال دائم لكل خيط بنمط WAL
+
+مثال:
+    python bench/sqlite_bench.py --users 5000 --ops 20000 --threads 1 8
+
+يُشغل كل نمط على ملف قاعدة بيانات جديد ويقيس دوال sy.py نفسها:
+قراءات (get_user_city)، كتابات (flush_user_writes بصف واحد لكل معاملة)، ومزيج 80/20 كما في موجات /start.
+لكل حالة يُطبع: العمليات/ثانية، p50 و p99 لزمن العملية، وعدد أخطاء القفل.
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+MODES = ("per_call", "persistent")
+WORKLOADS = ("read", "write", "mixed")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="مقارنة أنماط اتصال SQLite في sy.py")
+    parser.add_argument("--users", type=int, default=5000, help="عدد المستخدمين المزروعين")
+    parser.add_argument("--ops", type=int, default=20000, help="عدد العمليات لكل حالة")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 8], help="أعداد الخيوط المتزامنة")
+    parser.add_argument("--workloads", default=",".join(WORKLOADS), help="read,write,mixed")
+    parser.add_argument("--json", action="store_true", help="طباعة النتائج بصيغة JSON")
+    return parser.parse_args()
+
+
+def seed_users(sy, count):
+    with sy.db_connection() as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO users (user_id, is_premium, city_code) VALUES (?, 0, ?)",
+            [(user_id, random.choice(list(sy.CITY_CODES.values()))) for user_id in range(count)]
+        )
+        conn.commit()
+
+
+def make_operation(sy, workload, users):
+    city_codes = list(sy.CITY_CODES.values())
+
+    def read():
+        sy.get_user_city(random.randrange(users))
+
+    def write():
+        sy.flush_user_writes([(random.randrange(users), random.choice(city_codes))], [])
+
+    if workload == "read":
+        return read
+    if workload == "write":
+        return write
+    return lambda: write() if random.random() < 0.2 else read()
+
+
+def run_case(sy, operation, ops, threads):
+    latencies = []
+    errors = 0
+
+    def timed():
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            operation()
+        except sqlite3.OperationalError:
+            errors += 1
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for _ in executor.map(lambda _: timed(), range(ops)):
+            pass
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "ops_per_s": ops / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))] * 1000,
+        "lock_errors": errors,
+    }
+
+
+def main():
+    args = parse_args()
+    os.environ.pop("DATABASE_URL", None)
+    os.environ.setdefault("TOKEN", "123456:bench")
+    import sy
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+
+    workloads = [w for w in args.workloads.split(",") if w]
+    results = []
+    for mode in MODES:
+        sy.SQLITE_PATH = os.path.join(tempfile.mkdtemp(prefix="sy-sqlite-bench-"), "bench.db")
+        sy.SQLITE_PERSISTENT = mode == "persistent"
+        sy.setup_db()
+        seed_users(sy, args.users)
+        for workload in workloads:
+            operation = make_operation(sy, workload, args.users)
+            for threads in args.threads:
+                results.append({
+                    "mode": mode,
+                    "workload": workload,
+                    "threads": threads,
+                    **run_case(sy, operation, args.ops, threads),
+                })
+        sy.close_sqlite_connections()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    header = f"{'mode':<11} {'workload':<8} {'threads':>7} {'ops/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'locked':>7}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['mode']:<11} {r['workload']:<8} {r['threads']:>7} {r['ops_per_s']:>10.0f} "
+            f"{r['p50_ms']:>8.3f} {r['p99_ms']:>8.3f} {r['lock_errors']:>7}"
+        )
+
+
+if __name__ == "__main__":
+    main()
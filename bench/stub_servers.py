@@ -0,0 +1,199 @@
+"""خوادم محلية بديلة لـ Telegram Bot API و aladhan و wttr.in لاختبارات الحمل
+
+تعمل الخوادم في عملية منفصلة حتى لا تؤثر على قياس حلقة أحداث البوت، مع
+تأخير قابل للضبط وحقن أخطاء 429 و 500 (و 403 لـ Telegram).
+إحصائيات كل خادم متاحة عبر GET /__stats.
+"""
+import asyncio
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+from collections import Counter
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+REASONS = {200: "OK", 403: "Forbidden", 404: "Not Found", 429: "Too Many Requests", 500: "Internal Server Error"}
+
+
+class StubServer:
+    """خادم HTTP/1.1 بسيط يدعم keep-alive مع تأخير وحقن أخطاء"""
+
+    def __init__(self, name, route, latency=0.0, rate_429=0.0, rate_500=0.0, rate_403=0.0):
+        self.name = name
+        self.route = route
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.rate_500 = rate_500
+        self.rate_403 = rate_403
+        self.stats = Counter()
+
+    async def start(self, host="127.0.0.1", port=0):
+        server = await asyncio.start_server(self._handle_connection, host, port, backlog=1024)
+        return server.sockets[0].getsockname()[1]
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, value = line.decode("latin-1").split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+                length = int(headers.get("content-length") or 0)
+                body = await reader.readexactly(length) if length else b""
+
+                status, content_type, payload = await self._dispatch(method, target, headers, body)
+                writer.write(
+                    f"HTTP/1.1 {status} {REASONS.get(status, 'OK')}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    f"Connection: keep-alive\r\n\r\n".encode("latin-1") + payload
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method, target, headers, body):
+        parsed = urlparse(target)
+        if parsed.path == "/__stats":
+            return 200, "application/json", json.dumps(self.stats).encode()
+        if parsed.path == "/__reset":
+            self.stats.clear()
+            return 200, "application/json", b"{}"
+
+        self.stats["requests"] += 1
+        if self.latency:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+
+        roll = random.random()
+        if roll < self.rate_429:
+            self.stats["injected_429"] += 1
+            return self.route.error(429)
+        if roll < self.rate_429 + self.rate_500:
+            self.stats["injected_500"] += 1
+            return self.route.error(500)
+
+        content_type = headers.get("content-type", "")
+        if body and content_type.startswith("application/json"):
+            params = json.loads(body)
+        else:
+            params = {k: v[0] for k, v in parse_qs(body.decode() or parsed.query).items()}
+        params.update({k: v[0] for k, v in parse_qs(parsed.query).items()})
+        return self.route(self, parsed.path, params)
+
+
+class TelegramRoute:
+    """محاكاة الحد الأدنى من Bot API اللازم للبوت"""
+
+    def __init__(self):
+        self.message_id = 0
+
+    def error(self, status):
+        if status == 429:
+            payload = {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                       "parameters": {"retry_after": 1}}
+        else:
+            payload = {"ok": False, "error_code": status, "description": REASONS[status]}
+        return status, "application/json", json.dumps(payload).encode()
+
+    def __call__(self, server, path, params):
+        api_method = path.rsplit("/", 1)[-1]
+        server.stats[api_method] += 1
+        if api_method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif api_method in ("sendMessage", "editMessageText", "sendPhoto"):
+            if api_method == "sendMessage" and random.random() < server.rate_403:
+                server.stats["injected_403"] += 1
+                payload = {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+                return 403, "application/json", json.dumps(payload).encode()
+            self.message_id += 1
+            chat_id = int(params.get("chat_id") or 0)
+            result = {
+                "message_id": self.message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        return 200, "application/json", json.dumps({"ok": True, "result": result}).encode()
+
+
+class AladhanRoute:
+    """مواقيت صلاة واقعية من الحاسبة المحلية بصيغة aladhan"""
+
+    def error(self, status):
+        return status, "application/json", json.dumps({"code": status, "status": REASONS[status]}).encode()
+
+    def __call__(self, server, path, params):
+        import sy
+
+        city_en = params.get("city", "Damascus")
+        if path.endswith("calendarByCity"):
+            year, month = int(params["year"]), int(params["month"])
+            day = datetime.date(year, month, 1)
+            data = []
+            while day.month == month:
+                timings = {k: f"{v} (+03)" for k, v in sy.get_offline_timings(city_en, day).items()}
+                data.append({"timings": timings, "date": {"gregorian": {"date": day.strftime("%d-%m-%Y")}}})
+                day += datetime.timedelta(days=1)
+        else:
+            data = {"timings": sy.get_offline_timings(city_en, datetime.date.today())}
+        return 200, "application/json", json.dumps({"code": 200, "status": "OK", "data": data}).encode()
+
+
+class WttrRoute:
+    """تقرير طقس نصي بصيغة wttr.in المختصرة"""
+
+    def error(self, status):
+        return status, "text/plain", REASONS[status].encode()
+
+    def __call__(self, server, path, params):
+        return 200, "text/plain; charset=utf-8", "Sunny +25°C ↗10km/h 40%".encode()
+
+
+async def _serve(config, port_queue):
+    servers = {
+        "telegram": StubServer("telegram", TelegramRoute(), **config.get("telegram", {})),
+        "aladhan": StubServer("aladhan", AladhanRoute(), **config.get("aladhan", {})),
+        "wttr": StubServer("wttr", WttrRoute(), **config.get("wttr", {})),
+    }
+    ports = {name: await server.start() for name, server in servers.items()}
+    port_queue.put(ports)
+    await asyncio.Event().wait()
+
+
+def _run(config, port_queue):
+    asyncio.run(_serve(config, port_queue))
+
+
+def start_stub_servers(config=None):
+    """تشغيل الخوادم الثلاثة في عملية منفصلة وإرجاع (العملية، المنافذ)
+
+    config: {'telegram': {'latency': 0.05, 'rate_429': 0.01, 'rate_500': 0.0, 'rate_403': 0.0}, ...}
+    """
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run, args=(config or {}, port_queue), daemon=True)
+    process.start()
+    return process, port_queue.get(timeout=30)
+
+
+if __name__ == "__main__":
+    process, ports = start_stub_servers()
+    print(json.dumps(ports))
+    process.join()
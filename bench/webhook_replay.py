@@ -0,0 +1,403 @@
+"""إعادة تشغيل تحديثات Telegram على webhook البوت وقياس زمن كل معالج
+
+يرسل التحديثات (من ملف JSONL مسجل أو مولدة) عبر POST إلى webhook حقيقي
+بمعدل ثابت، مع Bot API بديل محلي، ثم يطبع زمن كل معالج وزمن قاعدة البيانات
+لكل تحديث.
+
+مثال:
+    python bench/webhook_replay.py --updates 5000 --rate 500
+    python bench/webhook_replay.py --corpus updates.jsonl --rate 200 --json
+    python bench/webhook_replay.py --updates 2000 --save-corpus updates.jsonl
+"""
+import argparse
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_servers import start_stub_servers
+
+BENCH_OWNER_ID = 1
+BENCH_TOKEN = "123456:bench"
+BENCH_USER_ID_BASE = 9_000_000_000
+DEFAULT_MIX = "start=4,city=3,order=2,admin=1,confirm=1"
+ADMIN_CALLBACKS = ("admin_stats", "admin_stats_detailed", "admin_stats_finance", "admin_stats_geo")
+ORDER_NOT_FOUND_REPLY = "❌ لم يتم العثور على طلب"
+
+_db_seconds = contextvars.ContextVar("db_seconds", default=None)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="قياس قدرة معالجات webhook على استيعاب التحديثات")
+    parser.add_argument("--corpus", help="ملف JSONL يحتوي تحديثات Telegram مسجلة")
+    parser.add_argument("--updates", type=int, default=2000, help="عدد التحديثات المولدة عند عدم تحديد --corpus")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="أوزان أنواع التحديثات المولدة")
+    parser.add_argument("--users", type=int, default=1000, help="عدد المستخدمين المولدين")
+    parser.add_argument("--rate", type=float, default=200, help="عدد التحديثات المرسلة في الثانية")
+    parser.add_argument("--connections", type=int, default=40, help="أقصى عدد طلبات POST متزامنة")
+    parser.add_argument("--db", choices=("sqlite", "postgres"), default="sqlite")
+    parser.add_argument("--tg-latency", type=float, default=0.02, help="تأخير Bot API بالثواني")
+    parser.add_argument("--tg-429", type=float, default=0.0)
+    parser.add_argument("--tg-500", type=float, default=0.0)
+    parser.add_argument("--save-corpus", help="حفظ التحديثات المولدة في ملف JSONL ثم الخروج")
+    parser.add_argument("--json", action="store_true", help="طباعة النتائج بصيغة JSON")
+    parser.add_argument("--verbose", action="store_true", help="إظهار سجلات البوت")
+    return parser.parse_args()
+
+
+# ==================== توليد التحديثات ====================
+def _user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"u{user_id}"}
+
+
+def command_update(update_id, user_id, text):
+    command = text.split()[0]
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": _user(user_id),
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+        },
+    }
+
+
+def callback_update(update_id, user_id, data):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": _user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "bench"},
+                "text": "...",
+            },
+        },
+    }
+
+
+def generate_corpus(count, mix, users, city_ens):
+    """توليد تحديثات تركيبية بنسب محددة
+
+    أوامر /as تستخدم طلبات مزروعة مسبقاً لنصف المستخدمين، وضغطات ACTIVATE_ORDER تأتي من
+    النصف الآخر حتى لا يستبدل طلب جديد طلباً مزروعاً قبل تأكيده.
+    """
+    weights = dict(item.split("=") for item in mix.split(","))
+    kinds = list(weights)
+    kind_weights = [float(weights[k]) for k in kinds]
+    shuffled = list(range(users))
+    random.shuffle(shuffled)
+    pending_orders = shuffled[:users // 2]
+    order_senders = shuffled[users // 2:] or shuffled
+    corpus = []
+    for update_id in range(1, count + 1):
+        kind = random.choices(kinds, kind_weights)[0]
+        user_id = BENCH_USER_ID_BASE + random.randrange(users)
+        if kind == "start":
+            corpus.append(command_update(update_id, user_id, "/start"))
+        elif kind == "city":
+            corpus.append(callback_update(update_id, user_id, f"CITY_CHOICE_{random.choice(city_ens)}"))
+        elif kind == "order":
+            order_user = BENCH_USER_ID_BASE + random.choice(order_senders)
+            corpus.append(callback_update(update_id, order_user, "ACTIVATE_ORDER"))
+        elif kind == "admin":
+            corpus.append(callback_update(update_id, BENCH_OWNER_ID, random.choice(ADMIN_CALLBACKS)))
+        elif kind == "confirm" and pending_orders:
+            order_user = BENCH_USER_ID_BASE + pending_orders.pop()
+            corpus.append(command_update(update_id, BENCH_OWNER_ID, f"/as bench-{order_user}"))
+    return corpus
+
+
+# ==================== القياس ====================
+def seed_users(sy, users):
+    """زرع مستخدمين لديهم مدينة وطلب دفع معلق"""
+    placeholder = "%s" if sy.DATABASE_URL else "?"
+    rows = [
+        (BENCH_USER_ID_BASE + i, random.choice(list(sy.CITY_CODES.values())), f"bench-{BENCH_USER_ID_BASE + i}")
+        for i in range(users)
+    ]
+    with sy.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"DELETE FROM users WHERE user_id >= {placeholder}", (BENCH_USER_ID_BASE,))
+        cursor.executemany(
+            f"INSERT INTO users (user_id, city_code, order_id) VALUES ({placeholder}, {placeholder}, {placeholder})",
+            rows
+        )
+        conn.commit()
+    sy.load_premium_index()
+
+
+def remove_users(sy):
+    placeholder = "%s" if sy.DATABASE_URL else "?"
+    with sy.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"DELETE FROM users WHERE user_id >= {placeholder}", (BENCH_USER_ID_BASE,))
+        conn.commit()
+
+
+def count_lost_orders(sy, order_users):
+    """المستخدمون المزروعون الذين ضغطوا ACTIVATE_ORDER وما زال طلبهم المزروع في قاعدة البيانات"""
+    placeholder = "%s" if sy.DATABASE_URL else "?"
+    with sy.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT user_id, order_id FROM users WHERE user_id >= {placeholder}", (BENCH_USER_ID_BASE,))
+        orders = dict(cursor.fetchall())
+    return sum(1 for user_id in order_users if orders.get(user_id) == f"bench-{user_id}")
+
+
+def instrument_db(sy):
+    """احتساب زمن كل اتصال بقاعدة البيانات للتحديث الجاري"""
+    original = sy.db_connection
+
+    @contextmanager
+    def timed_db_connection():
+        started = time.perf_counter()
+        try:
+            with original() as conn:
+                yield conn
+        finally:
+            bucket = _db_seconds.get()
+            if bucket is not None:
+                bucket[0] += time.perf_counter() - started
+
+    sy.db_connection = timed_db_connection
+
+
+def instrument_handlers(application, samples):
+    """تغليف كل معالج لتسجيل زمنه وزمن قاعدة البيانات داخله"""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            callback = handler.callback
+
+            @functools.wraps(callback)
+            async def timed(update, context, callback=callback):
+                bucket = [0.0]
+                token = _db_seconds.set(bucket)
+                started = time.perf_counter()
+                try:
+                    return await callback(update, context)
+                finally:
+                    samples[callback.__name__].append((time.perf_counter() - started, bucket[0]))
+                    _db_seconds.reset(token)
+
+            handler.callback = timed
+
+
+def instrument_replies(application, failures):
+    """عد ردود البوت التي تعني فشل المسار رغم نجاح المعالج، مثل /as لطلب غير موجود"""
+    bot_class = type(application.bot)
+    original = bot_class.send_message
+
+    @functools.wraps(original)
+    async def send_message(self, *args, **kwargs):
+        if str(kwargs.get("text", "")).startswith(ORDER_NOT_FOUND_REPLY):
+            failures["order_not_found"] += 1
+        return await original(self, *args, **kwargs)
+
+    bot_class.send_message = send_message
+    return lambda: setattr(bot_class, "send_message", original)
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))] if values else 0.0
+
+
+async def replay(corpus, rate, connections, webhook_url):
+    """إرسال التحديثات بمعدل ثابت (حلقة مفتوحة) وإرجاع أزمنة الاستجابة"""
+    import httpx
+
+    semaphore = asyncio.Semaphore(connections)
+    ack_latencies = []
+    errors = 0
+    limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        async def post(update):
+            nonlocal errors
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await client.post(webhook_url, json=update)
+                    if response.status_code != 200:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                ack_latencies.append(time.perf_counter() - started)
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        tasks = []
+        for i, update in enumerate(corpus):
+            delay = started + i / rate - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(post(update)))
+        await asyncio.gather(*tasks)
+    return ack_latencies, errors
+
+
+async def run(args, corpus, ports):
+    import sy
+    from tornado.httpserver import HTTPServer
+
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    sy.BASE_PRAYER_API = f"http://127.0.0.1:{ports['aladhan']}" + sy.BASE_PRAYER_API.split("api.aladhan.com", 1)[1]
+    sy.BASE_WEATHER_API = f"http://127.0.0.1:{ports['wttr']}/" + sy.BASE_WEATHER_API.split("wttr.in/", 1)[1]
+
+    sy.init_db_pool()
+    sy.setup_db()
+    await asyncio.to_thread(seed_users, sy, args.users)
+    instrument_db(sy)
+
+    samples = defaultdict(list)
+    failures = defaultdict(int)
+    application = sy.build_application()
+    instrument_handlers(application, samples)
+    restore_replies = instrument_replies(application, failures)
+    order_users = {
+        update["callback_query"]["from"]["id"] for update in corpus
+        if update.get("callback_query", {}).get("data") == "ACTIVATE_ORDER"
+        and update["callback_query"]["from"]["id"] >= BENCH_USER_ID_BASE
+    }
+    await application.initialize()
+    await sy.start_http_client()
+    sy.start_db_executor()
+    await sy.run_db(sy.load_premium_index)
+
+    port = _free_port()
+    webhook_url = f"http://127.0.0.1:{port}/{sy.TOKEN}"
+    server = HTTPServer(sy.create_web_app(application))
+    server.listen(port, "127.0.0.1")
+    await application.start()
+    try:
+        started = time.perf_counter()
+        ack_latencies, errors = await replay(corpus, args.rate, args.connections, webhook_url)
+        await application.update_queue.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        server.stop()
+        # stop ينتظر انتهاء كل التحديثات؛ بعدها تُكتب الطلبات المؤجلة ويُتحقق من وصولها
+        await application.stop()
+        await sy.flush_write_behind()
+        failures["lost_orders"] = await sy.run_db(count_lost_orders, sy, order_users)
+        restore_replies()
+        await application.shutdown()
+        await sy.close_http_client()
+        sy.shutdown_db_executor()
+        if args.db == "postgres":
+            await asyncio.to_thread(remove_users, sy)
+        sy.close_db_pool()
+
+    handlers = {}
+    for name, values in samples.items():
+        latencies = [v[0] for v in values]
+        db_times = [v[1] for v in values]
+        handlers[name] = {
+            "count": len(values),
+            "p50_ms": _percentile(latencies, 50) * 1000,
+            "p95_ms": _percentile(latencies, 95) * 1000,
+            "p99_ms": _percentile(latencies, 99) * 1000,
+            "db_mean_ms": sum(db_times) / len(db_times) * 1000,
+            "db_p95_ms": _percentile(db_times, 95) * 1000,
+        }
+    return {
+        "updates": len(corpus),
+        "target_rate": args.rate,
+        "wall_s": elapsed,
+        "updates_per_s": len(corpus) / elapsed if elapsed > 0 else 0,
+        "post_errors": errors,
+        "failed_confirmations": failures["order_not_found"],
+        "lost_orders": failures["lost_orders"],
+        "ack_p50_ms": _percentile(ack_latencies, 50) * 1000,
+        "ack_p99_ms": _percentile(ack_latencies, 99) * 1000,
+        "processing": sy._update_processor.latency_percentiles(),
+        "handlers": handlers,
+    }
+
+
+def print_results(result):
+    print(
+        f"{result['updates']} تحديث خلال {result['wall_s']:.2f} ثانية "
+        f"({result['updates_per_s']:.1f}/ثانية، الهدف {result['target_rate']:.0f})، "
+        f"أخطاء POST: {result['post_errors']}"
+    )
+    print(
+        f"طلبات /as غير موجودة: {result['failed_confirmations']}، "
+        f"طلبات ACTIVATE_ORDER غير محفوظة: {result['lost_orders']}"
+    )
+    print(f"زمن استجابة webhook: p50 {result['ack_p50_ms']:.1f}ms، p99 {result['ack_p99_ms']:.1f}ms")
+    header = f"{'handler':<28} {'count':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'db mean':>8} {'db p95':>8}"
+    print(header)
+    print("-" * len(header))
+    for name, h in sorted(result["handlers"].items()):
+        print(
+            f"{name:<28} {h['count']:>7} {h['p50_ms']:>8.1f} {h['p95_ms']:>8.1f} {h['p99_ms']:>8.1f} "
+            f"{h['db_mean_ms']:>8.2f} {h['db_p95_ms']:>8.2f}"
+        )
+
+
+def load_corpus(args):
+    if args.corpus:
+        with open(args.corpus, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    import sy
+    return generate_corpus(args.updates, args.mix, args.users, list(sy.CITY_CODES))
+
+
+def main():
+    args = parse_args()
+    if args.save_corpus:
+        with open(args.save_corpus, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(update, ensure_ascii=False) + "\n" for update in load_corpus(args))
+        return
+
+    # تشغيل الخوادم البديلة وضبط البيئة قبل استيراد sy لأن إعداداته تُقرأ عند الاستيراد
+    stub_process, ports = start_stub_servers({
+        "telegram": {"latency": args.tg_latency, "rate_429": args.tg_429, "rate_500": args.tg_500},
+    })
+    if args.db == "sqlite":
+        os.environ.pop("DATABASE_URL", None)
+        os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="sy-replay-"), "bench.db")
+    elif not os.environ.get("DATABASE_URL"):
+        sys.exit("❌ يجب تحديد DATABASE_URL عند استخدام --db postgres")
+    os.environ["TOKEN"] = BENCH_TOKEN
+    os.environ["OWNER_ID"] = str(BENCH_OWNER_ID)
+    os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{ports['telegram']}/bot"
+    try:
+        result = asyncio.run(run(args, load_corpus(args), ports))
+    finally:
+        stub_process.terminate()
+    if args.json:
+        print(json.dumps(result, indent=2, ensure_ascii=False))
+    else:
+        print_results(result)
+
+if __name__ == "__main__":
+    main()
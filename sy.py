@@ -1,19 +1,33 @@
 import os
 import datetime
-import requests
 import logging
 import random
 import time
 import sys
 import sqlite3
+import threading
+import functools
+import contextvars
+import math
+import json
+import re
+import signal
+from array import array
 from urllib.parse import urlparse
-from collections import defaultdict
+from zoneinfo import ZoneInfo
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import asyncio
 
+import httpx
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.ext import Application, ApplicationHandlerStop, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, TypeHandler, filters
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from tornado.httpserver import HTTPServer
+from tornado.web import Application as WebApplication, RequestHandler
 
 # ==================== إعدادات Logging ====================
 logging.basicConfig(
@@ -27,9 +41,73 @@ TOKEN = os.environ.get("TOKEN")
 OWNER_ID_STR = os.environ.get("OWNER_ID") 
 WEBHOOK_URL = os.environ.get("WEBHOOK_URL") 
 PORT = int(os.environ.get('PORT', '10000'))
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org/bot')
+METRICS_PATH = os.environ.get('METRICS_PATH', '/metrics')
 PAYMENT_QR_CODE_CONTENT = os.environ.get("PAYMENT_CODE", "f03c73ecadf2eda455d7be0732207d68") 
 QR_CODE_IMAGE_FILE_ID = os.environ.get("QR_FILE_ID", "AgACAgQAAxkBAAMeaStcosjM_zUZZajf9YbiBqvP2V8AAicMaxs7hlhRo_6zeTTibMABAAMCAAN4AAM2BA") 
 DATABASE_URL = os.environ.get('DATABASE_URL')
+SQLITE_PATH = os.environ.get('SQLITE_PATH', 'subscribers.db')
+SQLITE_PERSISTENT = os.environ.get('SQLITE_PERSISTENT', '1') == '1'
+SQLITE_BUSY_TIMEOUT = float(os.environ.get('SQLITE_BUSY_TIMEOUT', '5'))
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', str(64 * 1024 * 1024)))
+SQLITE_CACHED_STATEMENTS = int(os.environ.get('SQLITE_CACHED_STATEMENTS', '256'))
+PRAYER_FETCH_CONCURRENCY = int(os.environ.get('PRAYER_FETCH_CONCURRENCY', '5'))
+PRAYER_TIMES_SOURCE = os.environ.get('PRAYER_TIMES_SOURCE', 'api')
+PRAYER_CACHE_DAYS = int(os.environ.get('PRAYER_CACHE_DAYS', '30'))
+PRAYER_CACHE_MAX_STALE_DAYS = int(os.environ.get('PRAYER_CACHE_MAX_STALE_DAYS', '7'))
+PRAYER_MISFIRE_GRACE = int(os.environ.get('PRAYER_MISFIRE_GRACE', '300'))
+CONTENT_CATCHUP_MINUTES = int(os.environ.get('CONTENT_CATCHUP_MINUTES', '120'))
+BOT_TIMEZONE = ZoneInfo('Asia/Damascus')
+HTTP_MAX_CONNECTIONS = int(os.environ.get('HTTP_MAX_CONNECTIONS', '20'))
+HTTP_MAX_KEEPALIVE = int(os.environ.get('HTTP_MAX_KEEPALIVE', '10'))
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', '2'))
+HTTP_BACKOFF_BASE = float(os.environ.get('HTTP_BACKOFF_BASE', '0.5'))
+WEATHER_CACHE_TTL = int(os.environ.get('WEATHER_CACHE_TTL', '1800'))
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '10'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))
+DB_POOL_IDLE_CHECK = int(os.environ.get('DB_POOL_IDLE_CHECK', '60'))
+DB_EXECUTOR_WORKERS = int(os.environ.get('DB_EXECUTOR_WORKERS', str(DB_POOL_MAX)))
+UPDATE_CONCURRENCY = int(os.environ.get('UPDATE_CONCURRENCY', '32'))
+UPDATE_QUEUE_SIZE = int(os.environ.get('UPDATE_QUEUE_SIZE', '0'))
+UPDATE_LATENCY_SAMPLES = int(os.environ.get('UPDATE_LATENCY_SAMPLES', '1000'))
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', '40'))
+STATS_CACHE_TTL = int(os.environ.get('STATS_CACHE_TTL', '30'))
+PREMIUM_INDEX_VERIFY_MINUTES = int(os.environ.get('PREMIUM_INDEX_VERIFY_MINUTES', '30'))
+BROADCAST_CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY', '100'))
+BROADCAST_GLOBAL_RATE = float(os.environ.get('BROADCAST_GLOBAL_RATE', '25'))
+BROADCAST_PER_CHAT_INTERVAL = float(os.environ.get('BROADCAST_PER_CHAT_INTERVAL', '1'))
+BROADCAST_MAX_RETRIES = int(os.environ.get('BROADCAST_MAX_RETRIES', '3'))
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', '200'))
+OUTBOX_LEASE_SECONDS = int(os.environ.get('OUTBOX_LEASE_SECONDS', '60'))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '5'))
+OUTBOX_RETRY_DELAY = int(os.environ.get('OUTBOX_RETRY_DELAY', '30'))
+OUTBOX_POLL_INTERVAL = float(os.environ.get('OUTBOX_POLL_INTERVAL', '5'))
+OUTBOX_ACK_INTERVAL = float(os.environ.get('OUTBOX_ACK_INTERVAL', '0.5'))
+MESSAGE_COALESCE_WINDOW = float(os.environ.get('MESSAGE_COALESCE_WINDOW', '0'))
+TELEGRAM_MESSAGE_LIMIT = 4096
+WRITE_BEHIND_INTERVAL = float(os.environ.get('WRITE_BEHIND_INTERVAL', '0.3'))
+WRITE_BEHIND_MAX_ROWS = int(os.environ.get('WRITE_BEHIND_MAX_ROWS', '500'))
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '10000'))
+THROTTLE_COMMAND_RATE = float(os.environ.get('THROTTLE_COMMAND_RATE', '1'))
+THROTTLE_COMMAND_BURST = int(os.environ.get('THROTTLE_COMMAND_BURST', '5'))
+THROTTLE_CALLBACK_RATE = float(os.environ.get('THROTTLE_CALLBACK_RATE', '2'))
+THROTTLE_CALLBACK_BURST = int(os.environ.get('THROTTLE_CALLBACK_BURST', '6'))
+THROTTLE_ORDER_RATE = float(os.environ.get('THROTTLE_ORDER_RATE', str(1 / 30)))
+THROTTLE_ORDER_BURST = int(os.environ.get('THROTTLE_ORDER_BURST', '2'))
+THROTTLE_GLOBAL_RATE = float(os.environ.get('THROTTLE_GLOBAL_RATE', '300'))
+THROTTLE_IDLE_SECONDS = int(os.environ.get('THROTTLE_IDLE_SECONDS', '300'))
+THROTTLE_MAX_BUCKETS = int(os.environ.get('THROTTLE_MAX_BUCKETS', '50000'))
+
+# أولويات الإرسال من صندوق الصادر: الأصغر يُرسل أولاً ويؤجل ما بعده
+SEND_PRIORITY_PRAYER = 0
+SEND_PRIORITY_AFTER_PRAYER = 1
+SEND_PRIORITY_CONTENT = 2
+SEND_PRIORITY_NAMES = {
+    SEND_PRIORITY_PRAYER: 'prayer',
+    SEND_PRIORITY_AFTER_PRAYER: 'after_prayer',
+    SEND_PRIORITY_CONTENT: 'content',
+}
 
 # ==================== روابط APIs ====================
 SYRIAN_CITIES = {
@@ -40,9 +118,307 @@ SYRIAN_CITIES = {
     "ريف دمشق": "Rif Dimashq"
 }
 
+# رموز ثابتة للمدن تُخزن في users.city_code - لا تغيّر رمزاً مستخدماً
+CITY_CODES = {
+    "Damascus": 1, "Aleppo": 2, "Homs": 3, "Hama": 4, "Latakia": 5,
+    "Tartus": 6, "Deir Ez-Zor": 7, "Raqqa": 8, "Al-Hasakah": 9, "Daraa": 10,
+    "As-Suwayda": 11, "Quneitra": 12, "Idlib": 13, "Rif Dimashq": 14
+}
+CITY_EN_BY_CODE = {code: city_en for city_en, code in CITY_CODES.items()}
+CITY_AR_BY_EN = {city_en: city_ar for city_ar, city_en in SYRIAN_CITIES.items()}
+CITY_AR_BY_CODE = {code: CITY_AR_BY_EN[city_en] for city_en, code in CITY_CODES.items()}
+
 BASE_PRAYER_API = "https://api.aladhan.com/v1/timingsByCity?city={city_en}&country=Syria&method=4"
+BASE_PRAYER_CALENDAR_API = "https://api.aladhan.com/v1/calendarByCity?city={city_en}&country=Syria&method=4&month={month}&year={year}"
 BASE_WEATHER_API = "https://wttr.in/{city_en}_Syria?format=%C+%t+%w+%h"
 
+# ==================== المقاييس ====================
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LATENESS_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600)
+METRICS = {
+    'bot_handler_duration_seconds': ('histogram', 'زمن تنفيذ معالجات الأوامر والأزرار'),
+    'bot_handler_errors_total': ('counter', 'استثناءات معالجات الأوامر والأزرار'),
+    'bot_db_query_duration_seconds': ('histogram', 'زمن دوال قاعدة البيانات'),
+    'bot_db_errors_total': ('counter', 'استثناءات دوال قاعدة البيانات'),
+    'bot_http_request_duration_seconds': ('histogram', 'زمن طلبات HTTP الخارجية'),
+    'bot_http_requests_total': ('counter', 'طلبات HTTP الخارجية حسب الحالة'),
+    'bot_telegram_send_duration_seconds': ('histogram', 'زمن استدعاءات send_message'),
+    'bot_telegram_send_total': ('counter', 'نتائج send_message'),
+    'bot_webhook_updates_total': ('counter', 'التحديثات المستلمة عبر webhook'),
+    'bot_webhook_rejected_total': ('counter', 'التحديثات المرفوضة بـ 503 لامتلاء حد UPDATE_QUEUE_SIZE'),
+    'bot_outbox_enqueued_total': ('counter', 'الرسائل المضافة إلى صندوق الصادر'),
+    'bot_outbox_completed_total': ('counter', 'محاولات تسليم رسائل صندوق الصادر حسب النتيجة'),
+    'bot_outbox_lateness_seconds': ('histogram', 'تأخر الإرسال عن الموعد المجدول حسب الأولوية', LATENESS_BUCKETS),
+    'bot_write_behind_rows_total': ('counter', 'صفوف المدن والطلبات المكتوبة دفعة واحدة حسب النتيجة'),
+    'bot_throttled_updates_total': ('counter', 'التحديثات المرفوضة بسبب تجاوز حد المعدل حسب النوع والنطاق'),
+}
+_metric_lock = threading.Lock()
+_metric_counters = defaultdict(float)
+_metric_histograms = {}
+
+def increment_counter(name, value=1, **labels):
+    """زيادة عداد بقيمة محددة"""
+    key = (name, tuple(sorted(labels.items())))
+    with _metric_lock:
+        _metric_counters[key] += value
+
+def _metric_buckets(name):
+    definition = METRICS.get(name, ())
+    return definition[2] if len(definition) > 2 else METRIC_BUCKETS
+
+def observe_histogram(name, seconds, **labels):
+    """تسجيل قيمة زمنية في مدرج تكراري"""
+    key = (name, tuple(sorted(labels.items())))
+    bounds = _metric_buckets(name)
+    with _metric_lock:
+        histogram = _metric_histograms.get(key)
+        if histogram is None:
+            histogram = _metric_histograms[key] = [[0] * len(bounds), 0.0, 0]
+        for i, bound in enumerate(bounds):
+            if seconds <= bound:
+                histogram[0][i] += 1
+                break
+        histogram[1] += seconds
+        histogram[2] += 1
+
+def timed_db(func):
+    """قياس زمن دالة قاعدة بيانات متزامنة وعدّ استثناءاتها"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            increment_counter('bot_db_errors_total', helper=func.__name__)
+            raise
+        finally:
+            observe_histogram('bot_db_query_duration_seconds', time.perf_counter() - started, helper=func.__name__)
+    return wrapper
+
+def timed_handler(func):
+    """قياس زمن معالج غير متزامن وعدّ استثناءاته"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            increment_counter('bot_handler_errors_total', handler=func.__name__)
+            raise
+        finally:
+            observe_histogram('bot_handler_duration_seconds', time.perf_counter() - started, handler=func.__name__)
+    return wrapper
+
+async def send_message_timed(bot, **kwargs):
+    """استدعاء bot.send_message مع تسجيل زمنه ونتيجته"""
+    started = time.perf_counter()
+    result = 'success'
+    try:
+        return await bot.send_message(**kwargs)
+    except RetryAfter:
+        result = 'retry_after'
+        raise
+    except Forbidden:
+        result = 'forbidden'
+        raise
+    except BadRequest:
+        result = 'bad_request'
+        raise
+    except NetworkError:
+        result = 'network_error'
+        raise
+    except Exception:
+        result = 'error'
+        raise
+    finally:
+        observe_histogram('bot_telegram_send_duration_seconds', time.perf_counter() - started)
+        increment_counter('bot_telegram_send_total', result=result)
+
+def counter_total(name, **labels):
+    """مجموع عداد عبر جميع التسميات المطابقة"""
+    wanted = set(labels.items())
+    with _metric_lock:
+        return sum(v for (n, l), v in _metric_counters.items() if n == name and wanted <= set(l))
+
+def histogram_summary(name, **labels):
+    """العدد والمتوسط والنسبة 95 التقريبية لمدرج عبر التسميات المطابقة"""
+    wanted = set(labels.items())
+    bounds = _metric_buckets(name)
+    buckets, total, count = [0] * len(bounds), 0.0, 0
+    with _metric_lock:
+        for (n, l), histogram in _metric_histograms.items():
+            if n == name and wanted <= set(l):
+                buckets = [a + b for a, b in zip(buckets, histogram[0])]
+                total += histogram[1]
+                count += histogram[2]
+    if not count:
+        return None
+    p95, cumulative = float('inf'), 0
+    for bound, bucket_count in zip(bounds, buckets):
+        cumulative += bucket_count
+        if cumulative >= 0.95 * count:
+            p95 = bound
+            break
+    return {'count': count, 'mean': total / count, 'p95': p95}
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+def render_metrics(outbox_stats=None):
+    """جميع المقاييس بصيغة Prometheus النصية"""
+    with _metric_lock:
+        counters = sorted(_metric_counters.items())
+        histograms = sorted((key, [list(h[0]), h[1], h[2]]) for key, h in _metric_histograms.items())
+    
+    lines = []
+    for name, (metric_type, help_text, *_) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for (n, labels), value in counters:
+            if n == name:
+                lines.append(f"{name}{_format_labels(labels)} {value:g}")
+        for (n, labels), (buckets, total, count) in histograms:
+            if n != name:
+                continue
+            cumulative = 0
+            for bound, bucket_count in zip(_metric_buckets(name), buckets):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', f'{bound:g}'),))} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+    
+    gauges = {
+        'bot_updates_in_flight': _update_processor.in_flight,
+        'bot_updates_pending': _update_processor.pending,
+        'bot_premium_subscribers': len(_premium_user_city),
+        'bot_dead_chats': len(_dead_chats),
+        'bot_write_behind_pending': len(_pending_city_writes) + len(_pending_order_writes),
+        'bot_throttle_buckets': len(_throttle_buckets),
+        'bot_weather_cache_hits_total': _weather_cache_stats['hits'],
+        'bot_weather_cache_misses_total': _weather_cache_stats['misses'],
+    }
+    pool_stats = get_db_pool_stats()
+    if pool_stats:
+        gauges['bot_db_pool_in_use'] = pool_stats['in_use']
+        gauges['bot_db_pool_idle'] = pool_stats['idle']
+    if outbox_stats:
+        gauges['bot_outbox_depth'] = outbox_stats['depth']
+        gauges['bot_outbox_due'] = outbox_stats['due']
+        gauges['bot_outbox_leased'] = outbox_stats['leased']
+        gauges['bot_outbox_oldest_due_age_seconds'] = round(outbox_stats['oldest_due_age'], 3)
+    for name, value in gauges.items():
+        lines.append(f"# TYPE {name} {'counter' if name.endswith('_total') else 'gauge'}")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+def get_metrics_health_lines():
+    """أسطر تقرير الصحة المستخرجة من المقاييس"""
+    def fmt(summary):
+        if not summary:
+            return "لا توجد بيانات"
+        p95 = "&gt;10s" if summary['p95'] == float('inf') else f"≤{summary['p95'] * 1000:.0f}ms"
+        return f"{summary['count']} طلب، متوسط {summary['mean'] * 1000:.0f}ms، p95 {p95}"
+    
+    def fmt_lateness(summary):
+        if not summary:
+            return "-"
+        p95 = f">{LATENESS_BUCKETS[-1]}s" if summary['p95'] == float('inf') else f"≤{summary['p95']}s"
+        return f"متوسط {summary['mean']:.1f}s، p95 {p95}"
+    
+    http_total = counter_total('bot_http_requests_total')
+    with _metric_lock:
+        http_failed = sum(
+            v for (n, l), v in _metric_counters.items()
+            if n == 'bot_http_requests_total' and not dict(l)['status'].startswith('2')
+        )
+    return [
+        f"⚙️ <b>المعالجات:</b> {fmt(histogram_summary('bot_handler_duration_seconds'))}، "
+        f"أخطاء {counter_total('bot_handler_errors_total'):.0f}",
+        f"🗄️ <b>استعلامات القاعدة:</b> {fmt(histogram_summary('bot_db_query_duration_seconds'))}، "
+        f"أخطاء {counter_total('bot_db_errors_total'):.0f}",
+        f"🌐 <b>طلبات HTTP:</b> {http_total:.0f}، فشل {http_failed:.0f}",
+        f"📨 <b>الإرسال:</b> ✅ {counter_total('bot_telegram_send_total', result='success'):.0f}، "
+        f"🚫 403: {counter_total('bot_telegram_send_total', result='forbidden'):.0f}، "
+        f"⏳ 429: {counter_total('bot_telegram_send_total', result='retry_after'):.0f}",
+        "⏱️ <b>تأخر الإرسال:</b> " + "، ".join(
+            f"{name} {fmt_lateness(histogram_summary('bot_outbox_lateness_seconds', priority=name))}"
+            for name in SEND_PRIORITY_NAMES.values()
+        ),
+        f"🚦 <b>تحديثات مرفوضة للإغراق:</b> مستخدم {counter_total('bot_throttled_updates_total', scope='user'):.0f}، "
+        f"عام {counter_total('bot_throttled_updates_total', scope='global'):.0f}",
+    ]
+
+# ==================== عميل HTTP المشترك ====================
+_http_client = None
+_http_semaphore = None
+
+async def start_http_client():
+    """إنشاء عميل HTTP مشترك يحتفظ بالاتصالات مفتوحة لكل مضيف"""
+    global _http_client, _http_semaphore
+    if _http_client is not None:
+        return
+    _http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=30
+        ),
+        timeout=10,
+        follow_redirects=True
+    )
+    _http_semaphore = asyncio.Semaphore(HTTP_MAX_CONNECTIONS)
+    logger.info("✅ تم تشغيل عميل HTTP المشترك")
+
+async def close_http_client():
+    """إغلاق عميل HTTP المشترك"""
+    global _http_client, _http_semaphore
+    if _http_client is None:
+        return
+    await _http_client.aclose()
+    _http_client = None
+    _http_semaphore = None
+    logger.info("✅ تم إغلاق عميل HTTP المشترك")
+
+async def http_get(url, timeout=10, retries=HTTP_RETRIES):
+    """طلب GET عبر العميل المشترك مع إعادة المحاولة عند الأخطاء المؤقتة"""
+    if _http_client is None:
+        await start_http_client()
+    
+    for attempt in range(retries + 1):
+        host = urlparse(url).hostname
+        try:
+            async with _http_semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await _http_client.get(url, timeout=timeout)
+                except httpx.TransportError:
+                    increment_counter('bot_http_requests_total', host=host, status='error')
+                    raise
+                finally:
+                    observe_histogram('bot_http_request_duration_seconds', time.perf_counter() - started, host=host)
+            increment_counter('bot_http_requests_total', host=host, status=str(response.status_code))
+            response.raise_for_status()
+            return response
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            transient = (
+                isinstance(e, httpx.TransportError)
+                or e.response.status_code == 429
+                or e.response.status_code >= 500
+            )
+            if not transient or attempt == retries:
+                raise
+            delay = HTTP_BACKOFF_BASE * (2 ** attempt) + random.uniform(0, HTTP_BACKOFF_BASE)
+            logger.warning(f"⚠️ إعادة محاولة الطلب ({attempt + 1}/{retries}) بعد {delay:.1f} ثانية: {e}")
+            await asyncio.sleep(delay)
+
+# ==================== ذاكرة الطقس المؤقتة ====================
+_weather_cache = {}
+_weather_inflight = {}
+_weather_cache_stats = {'hits': 0, 'misses': 0, 'coalesced': 0}
+
 # ==================== قوائم الأذكار المتنوعة ====================
 AZKAR_SABAH_LIST = [
     "📌 <b>أذكار الصباح:</b>\n\nاللهم بك أصبحنا، وبك أمسينا، وبك نحيا، وبك نموت، وإليك النشور. (مرة واحدة)",
@@ -81,369 +457,1104 @@ DEFAULT_SUPPLICATIONS = [
 ]
 
 # ==================== دوال قاعدة البيانات ====================
-def get_db_connection():
-    """إنشاء اتصال بقاعدة البيانات"""
-    try:
-        if DATABASE_URL:
-            import psycopg2
-            result = urlparse(DATABASE_URL)
-            port = result.port or 5432
-            conn = psycopg2.connect(
-                database=result.path[1:],
-                user=result.username,
-                password=result.password,
-                host=result.hostname,
-                port=port
-            )
-            return conn
-        else:
-            conn = sqlite3.connect("subscribers.db")
-            return conn
-    except Exception as e:
-        logger.error(f"❌ فشل الاتصال بقاعدة البيانات: {e}")
+_db_pool = None
+_db_pool_slots = None
+_db_pool_last_used = {}
+_db_pool_lock = threading.Lock()
+_db_pool_in_use = 0
+_sqlite_local = threading.local()
+_sqlite_connections = []
+
+def init_db_pool():
+    """إنشاء مجمع اتصالات PostgreSQL مرة واحدة عند بدء التشغيل"""
+    global _db_pool, _db_pool_slots
+    if not DATABASE_URL or _db_pool is not None:
+        return
+    from psycopg2 import pool
+    result = urlparse(DATABASE_URL)
+    port = result.port or 5432
+    _db_pool = pool.ThreadedConnectionPool(
+        DB_POOL_MIN,
+        DB_POOL_MAX,
+        database=result.path[1:],
+        user=result.username,
+        password=result.password,
+        host=result.hostname,
+        port=port
+    )
+    _db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+    logger.info(f"✅ تم إنشاء مجمع اتصالات قاعدة البيانات (الحد الأقصى {DB_POOL_MAX})")
+
+def _open_sqlite_connection():
+    """فتح اتصال SQLite دائم لهذا الخيط بنمط WAL وإعدادات الإنتاجية العالية"""
+    conn = sqlite3.connect(
+        SQLITE_PATH,
+        timeout=SQLITE_BUSY_TIMEOUT,
+        cached_statements=SQLITE_CACHED_STATEMENTS,
+        check_same_thread=False
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    conn.execute(f"PRAGMA busy_timeout={int(SQLITE_BUSY_TIMEOUT * 1000)}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    with _db_pool_lock:
+        _sqlite_connections.append(conn)
+    return conn
+
+def _get_sqlite_connection():
+    """اتصال SQLite الدائم الخاص بالخيط الحالي"""
+    conn = getattr(_sqlite_local, 'conn', None)
+    if conn is None:
+        conn = _sqlite_local.conn = _open_sqlite_connection()
+    return conn
+
+def close_sqlite_connections():
+    """إغلاق اتصالات SQLite الدائمة لجميع الخيوط"""
+    with _db_pool_lock:
+        connections = list(_sqlite_connections)
+        _sqlite_connections.clear()
+    for conn in connections:
         try:
-            conn = sqlite3.connect("subscribers.db")
-            return conn
-        except:
-            raise
+            conn.close()
+        except Exception:
+            pass
+    _sqlite_local.__dict__.clear()
+    if connections:
+        logger.info(f"✅ تم إغلاق {len(connections)} اتصال SQLite")
 
-def setup_db():
-    """إنشاء الجداول إذا لم تكن موجودة"""
-    conn = None
+def close_db_pool():
+    """إغلاق جميع اتصالات المجمع"""
+    global _db_pool, _db_pool_slots
+    close_sqlite_connections()
+    if _db_pool is None:
+        return
+    _db_pool.closeall()
+    _db_pool = None
+    _db_pool_slots = None
+    _db_pool_last_used.clear()
+    logger.info("✅ تم إغلاق مجمع اتصالات قاعدة البيانات")
+
+def _is_connection_alive(conn):
+    """فحص اتصال خامل قبل إعادة استخدامه"""
+    if conn.closed:
+        return False
     try:
-        conn = get_db_connection()
         cursor = conn.cursor()
-        
-        if DATABASE_URL:
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id BIGINT PRIMARY KEY,
-                    is_premium INTEGER DEFAULT 0,
-                    end_date TEXT,
-                    city_url TEXT DEFAULT NULL,
-                    order_id TEXT DEFAULT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-        else:
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    is_premium INTEGER DEFAULT 0,
-                    end_date TEXT,
-                    city_url TEXT DEFAULT NULL,
-                    order_id TEXT DEFAULT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-        
-        conn.commit()
-        logger.info("✅ تم إنشاء/تحقق من الجداول")
-    except Exception as e:
-        logger.error(f"❌ فشل في إعداد قاعدة البيانات: {e}")
+        cursor.execute("SELECT 1")
+        cursor.fetchone()
+        conn.rollback()
+        return True
+    except Exception:
+        return False
+
+def _acquire_pg_connection():
+    """استعارة اتصال سليم من المجمع"""
+    global _db_pool_in_use
+    if not _db_pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise TimeoutError("انتهت مهلة انتظار اتصال من المجمع")
+    try:
+        while True:
+            conn = _db_pool.getconn()
+            last_used = _db_pool_last_used.get(id(conn), 0)
+            if time.monotonic() - last_used < DB_POOL_IDLE_CHECK or _is_connection_alive(conn):
+                break
+            logger.warning("⚠️ تم استبعاد اتصال خامل معطل من المجمع")
+            _db_pool_last_used.pop(id(conn), None)
+            _db_pool.putconn(conn, close=True)
+    except Exception:
+        _db_pool_slots.release()
         raise
+    with _db_pool_lock:
+        _db_pool_in_use += 1
+    return conn
+
+def _release_pg_connection(conn):
+    """إعادة الاتصال إلى المجمع"""
+    global _db_pool_in_use
+    try:
+        if not conn.closed:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+        if conn.closed:
+            _db_pool_last_used.pop(id(conn), None)
+            _db_pool.putconn(conn, close=True)
+        else:
+            _db_pool_last_used[id(conn)] = time.monotonic()
+            _db_pool.putconn(conn)
     finally:
-        if conn:
+        with _db_pool_lock:
+            _db_pool_in_use -= 1
+        _db_pool_slots.release()
+
+@contextmanager
+def db_connection():
+    """الحصول على اتصال بقاعدة البيانات وإعادته تلقائياً بعد الاستخدام"""
+    if DATABASE_URL:
+        if _db_pool is None:
+            init_db_pool()
+        conn = _acquire_pg_connection()
+        try:
+            yield conn
+        finally:
+            _release_pg_connection(conn)
+    elif SQLITE_PERSISTENT:
+        conn = _get_sqlite_connection()
+        try:
+            yield conn
+        finally:
+            # الاتصال يبقى مفتوحاً، لذا لا يُترك أي عمل غير مثبت لاستدعاء لاحق
+            if conn.in_transaction:
+                conn.rollback()
+    else:
+        conn = sqlite3.connect(SQLITE_PATH)
+        try:
+            yield conn
+        finally:
             conn.close()
 
-def save_user_city(user_id, city_url):
-    """حفظ مدينة المستخدم"""
-    conn = None
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
+def get_db_pool_stats():
+    """إحصائيات استخدام مجمع الاتصالات"""
+    if _db_pool is None:
+        return None
+    return {
+        'in_use': _db_pool_in_use,
+        'idle': len(_db_pool._pool),
+        'max': DB_POOL_MAX
+    }
+
+@timed_db
+def check_db_connection():
+    """التحقق من إمكانية الاتصال بقاعدة البيانات"""
+    with db_connection():
+        pass
+    return True
+
+# ==================== الوصول غير المتزامن لقاعدة البيانات ====================
+_db_executor = None
+
+def start_db_executor():
+    """إنشاء منفذ مخصص لاستعلامات قاعدة البيانات"""
+    global _db_executor
+    if _db_executor is None:
+        _db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+
+def shutdown_db_executor():
+    """إيقاف منفذ قاعدة البيانات بعد انتهاء الاستعلامات الجارية"""
+    global _db_executor
+    if _db_executor is not None:
+        _db_executor.shutdown(wait=True)
+        _db_executor = None
+
+async def run_db(func, *args):
+    """تشغيل دالة قاعدة بيانات متزامنة على المنفذ المخصص دون حجب حلقة الأحداث"""
+    if _db_executor is None:
+        start_db_executor()
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(_db_executor, functools.partial(context.run, func, *args))
+
+# ==================== ترحيلات المخطط ====================
+# كل ترحيل: (الإصدار، الوصف، الأوامر). الأوامر قائمة مشتركة بين المحركين
+# أو قاموس {'postgres': [...], 'sqlite': [...]} عند اختلاف الصياغة.
+SCHEMA_MIGRATIONS = [
+    (1, "فهارس رقم الطلب والاشتراكات وتاريخ التسجيل", [
+        "CREATE INDEX IF NOT EXISTS idx_users_order_id ON users (order_id) WHERE order_id IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS idx_users_premium_end_date ON users (end_date) WHERE is_premium = 1",
+        "CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at)",
+    ]),
+    (2, "جدول تقويم مواقيت الصلاة", [
+        """
+        CREATE TABLE IF NOT EXISTS prayer_times (
+            city_en TEXT NOT NULL,
+            day TEXT NOT NULL,
+            fajr TEXT NOT NULL,
+            dhuhr TEXT NOT NULL,
+            asr TEXT NOT NULL,
+            maghrib TEXT NOT NULL,
+            isha TEXT NOT NULL,
+            PRIMARY KEY (city_en, day)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_prayer_times_day ON prayer_times (day)",
+    ]),
+    (3, "رمز المدينة بدلاً من رابط الـ API في users", {
+        'postgres': [
+            "CREATE TABLE IF NOT EXISTS cities (code SMALLINT PRIMARY KEY, name_en TEXT NOT NULL UNIQUE, name_ar TEXT NOT NULL)",
+            *[
+                f"INSERT INTO cities (code, name_en, name_ar) VALUES ({code}, '{city_en}', '{CITY_AR_BY_EN[city_en]}') ON CONFLICT (code) DO NOTHING"
+                for city_en, code in CITY_CODES.items()
+            ],
+            "ALTER TABLE users ADD COLUMN IF NOT EXISTS city_code SMALLINT REFERENCES cities (code)",
+            "UPDATE users SET city_code = (SELECT code FROM cities WHERE users.city_url LIKE '%city=' || cities.name_en || '&%') WHERE city_url IS NOT NULL",
+            "UPDATE users SET city_url = NULL WHERE city_code IS NOT NULL",
+            "CREATE INDEX IF NOT EXISTS idx_users_premium_city ON users (city_code) WHERE is_premium = 1",
+        ],
+        'sqlite': [
+            "CREATE TABLE IF NOT EXISTS cities (code INTEGER PRIMARY KEY, name_en TEXT NOT NULL UNIQUE, name_ar TEXT NOT NULL)",
+            *[
+                f"INSERT INTO cities (code, name_en, name_ar) VALUES ({code}, '{city_en}', '{CITY_AR_BY_EN[city_en]}') ON CONFLICT (code) DO NOTHING"
+                for city_en, code in CITY_CODES.items()
+            ],
+            "ALTER TABLE users ADD COLUMN city_code INTEGER REFERENCES cities (code)",
+            "UPDATE users SET city_code = (SELECT code FROM cities WHERE users.city_url LIKE '%city=' || cities.name_en || '&%') WHERE city_url IS NOT NULL",
+            "UPDATE users SET city_url = NULL WHERE city_code IS NOT NULL",
+            "CREATE INDEX IF NOT EXISTS idx_users_premium_city ON users (city_code) WHERE is_premium = 1",
+        ],
+    }),
+    (4, "صندوق الصادر للرسائل المعلقة", {
+        'postgres': [
+            """
+            CREATE TABLE IF NOT EXISTS outbox (
+                id BIGSERIAL PRIMARY KEY,
+                user_id BIGINT NOT NULL,
+                text TEXT NOT NULL,
+                label TEXT,
+                dedupe_key TEXT UNIQUE,
+                due_at DOUBLE PRECISION NOT NULL,
+                lease_until DOUBLE PRECISION NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (due_at, id)",
+            "CREATE TABLE IF NOT EXISTS outbox_broadcasts (dedupe_prefix TEXT PRIMARY KEY, queued INTEGER NOT NULL, created_at DOUBLE PRECISION NOT NULL)",
+        ],
+        'sqlite': [
+            """
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                label TEXT,
+                dedupe_key TEXT UNIQUE,
+                due_at REAL NOT NULL,
+                lease_until REAL NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (due_at, id)",
+            "CREATE TABLE IF NOT EXISTS outbox_broadcasts (dedupe_prefix TEXT PRIMARY KEY, queued INTEGER NOT NULL, created_at REAL NOT NULL)",
+        ],
+    }),
+    (5, "تاريخ توقف المحادثة للمستخدمين الذين حظروا البوت", {
+        'postgres': [
+            "ALTER TABLE users ADD COLUMN IF NOT EXISTS dead_since TIMESTAMP",
+            "CREATE INDEX IF NOT EXISTS idx_users_dead_since ON users (user_id) WHERE dead_since IS NOT NULL",
+        ],
+        'sqlite': [
+            "ALTER TABLE users ADD COLUMN dead_since TIMESTAMP",
+            "CREATE INDEX IF NOT EXISTS idx_users_dead_since ON users (user_id) WHERE dead_since IS NOT NULL",
+        ],
+    }),
+    (6, "أولوية رسائل صندوق الصادر", [
+        "ALTER TABLE outbox ADD COLUMN priority SMALLINT NOT NULL DEFAULT 2",
+        "DROP INDEX IF EXISTS idx_outbox_due",
+        "CREATE INDEX IF NOT EXISTS idx_outbox_priority_due ON outbox (priority, due_at, id)",
+    ]),
+]
+
+def _migration_statements(statements):
+    """اختيار أوامر الترحيل المناسبة لمحرك قاعدة البيانات الحالي"""
+    if isinstance(statements, dict):
+        return statements['postgres' if DATABASE_URL else 'sqlite']
+    return statements
+
+def run_migrations(conn):
+    """تطبيق الترحيلات غير المطبقة بالترتيب وتسجيل إصدار المخطط"""
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.commit()
+    
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    current_version = cursor.fetchone()[0]
+    
+    for version, description, statements in SCHEMA_MIGRATIONS:
+        if version <= current_version:
+            continue
+        for statement in _migration_statements(statements):
+            cursor.execute(statement)
         if DATABASE_URL:
-            cursor.execute("""
-                INSERT INTO users (user_id, city_url, is_premium) 
-                VALUES (%s, %s, 0)
-                ON CONFLICT (user_id) 
-                DO UPDATE SET city_url = EXCLUDED.city_url
-            """, (user_id, city_url))
+            cursor.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)", (version, description))
         else:
-            cursor.execute("""
-                INSERT OR REPLACE INTO users (user_id, city_url, is_premium) 
-                VALUES (?, ?, 0)
-            """, (user_id, city_url))
-        
+            cursor.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)", (version, description))
         conn.commit()
-        return True
-    except Exception as e:
-        logger.error(f"❌ فشل في حفظ مدينة للمستخدم {user_id}: {e}")
-        return False
-    finally:
-        if conn:
-            conn.close()
+        current_version = version
+        logger.info(f"✅ تم تطبيق الترحيل {version}: {description}")
+    
+    return current_version
 
-def update_user_order(user_id, order_id):
-    """تحديث رقم طلب المستخدم"""
-    conn = None
+def setup_db():
+    """إنشاء الجداول إذا لم تكن موجودة"""
     try:
-        conn = get_db_connection()
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            
+            if DATABASE_URL:
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS users (
+                        user_id BIGINT PRIMARY KEY,
+                        is_premium INTEGER DEFAULT 0,
+                        end_date TEXT,
+                        city_url TEXT DEFAULT NULL,
+                        order_id TEXT DEFAULT NULL,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
+            else:
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS users (
+                        user_id INTEGER PRIMARY KEY,
+                        is_premium INTEGER DEFAULT 0,
+                        end_date TEXT,
+                        city_url TEXT DEFAULT NULL,
+                        order_id TEXT DEFAULT NULL,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
+            
+            conn.commit()
+            schema_version = run_migrations(conn)
+        logger.info(f"✅ تم إنشاء/تحقق من الجداول (إصدار المخطط {schema_version})")
+    except Exception as e:
+        logger.error(f"❌ فشل في إعداد قاعدة البيانات: {e}")
+        raise
+
+@timed_db
+def flush_user_writes(cities, orders):
+    """كتابة المدن وأرقام الطلبات المؤجلة في معاملة واحدة
+    
+    cities: قائمة من (user_id, city_code)، orders: قائمة من (order_id, user_id)
+    """
+    with db_connection() as conn:
         cursor = conn.cursor()
-        
         if DATABASE_URL:
-            cursor.execute("UPDATE users SET order_id = %s WHERE user_id = %s", (order_id, user_id))
+            from psycopg2.extras import execute_values
+            if cities:
+                execute_values(cursor, """
+                    INSERT INTO users (user_id, city_code, is_premium) VALUES %s
+                    ON CONFLICT (user_id) DO UPDATE SET city_code = EXCLUDED.city_code
+                """, cities, template="(%s, %s, 0)", page_size=max(len(cities), 1))
+            if orders:
+                cursor.executemany("UPDATE users SET order_id = %s WHERE user_id = %s", orders)
         else:
-            cursor.execute("UPDATE users SET order_id = ? WHERE user_id = ?", (order_id, user_id))
-        
+            if cities:
+                cursor.executemany("""
+                    INSERT INTO users (user_id, city_code, is_premium) VALUES (?, ?, 0)
+                    ON CONFLICT (user_id) DO UPDATE SET city_code = excluded.city_code
+                """, cities)
+            if orders:
+                cursor.executemany("UPDATE users SET order_id = ? WHERE user_id = ?", orders)
         conn.commit()
-        return True
-    except Exception as e:
-        logger.error(f"❌ فشل في تحديث طلب المستخدم {user_id}: {e}")
-        return False
-    finally:
-        if conn:
-            conn.close()
 
+@timed_db
 def activate_premium(user_id, order_id):
     """تفعيل الاشتراك المميز للمستخدم"""
-    conn = None
     try:
         today_str = (datetime.date.today() + datetime.timedelta(days=7)).strftime("%Y-%m-%d")
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        if DATABASE_URL:
-            cursor.execute("""
-                UPDATE users SET is_premium = 1, end_date = %s, order_id = NULL 
-                WHERE user_id = %s AND order_id = %s
-            """, (today_str, user_id, order_id))
-        else:
-            cursor.execute("""
-                UPDATE users SET is_premium = 1, end_date = ?, order_id = NULL 
-                WHERE user_id = ? AND order_id = ?
-            """, (today_str, user_id, order_id))
-        
-        conn.commit()
-        success = cursor.rowcount > 0
-        conn.close()
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            
+            if DATABASE_URL:
+                cursor.execute("""
+                    UPDATE users SET is_premium = 1, end_date = %s, order_id = NULL 
+                    WHERE user_id = %s AND order_id = %s
+                """, (today_str, user_id, order_id))
+            else:
+                cursor.execute("""
+                    UPDATE users SET is_premium = 1, end_date = ?, order_id = NULL 
+                    WHERE user_id = ? AND order_id = ?
+                """, (today_str, user_id, order_id))
+            
+            conn.commit()
+            success = cursor.rowcount > 0
+            
+            if success:
+                if DATABASE_URL:
+                    cursor.execute("SELECT city_code FROM users WHERE user_id = %s", (user_id,))
+                else:
+                    cursor.execute("SELECT city_code FROM users WHERE user_id = ?", (user_id,))
+                row = cursor.fetchone()
+                add_to_premium_index(user_id, CITY_EN_BY_CODE.get(row[0]) if row else None)
         return success
     except Exception as e:
         logger.error(f"❌ فشل في تفعيل الاشتراك للمستخدم {user_id}: {e}")
         return False
 
+@timed_db
 def get_premium_users():
     """الحصول على جميع المستخدمين المميزين"""
-    conn = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id, city_url FROM users WHERE is_premium = 1")
-        users = cursor.fetchall()
-        conn.close()
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT user_id, city_code FROM users WHERE is_premium = 1 AND dead_since IS NULL")
+            users = cursor.fetchall()
         return users
     except Exception as e:
         logger.error(f"❌ فشل في جلب المستخدمين المميزين: {e}")
         return []
-    finally:
-        if conn:
-            conn.close()
 
-def get_user_counts():
-    """الحصول على إحصائيات المستخدمين"""
-    conn = None
-    try:
-        conn = get_db_connection()
+@timed_db
+def compute_stats_snapshot():
+    """حساب جميع أرقام لوحة الإحصائيات باستعلام تجميعي واحد"""
+    today = datetime.date.today()
+    today_start = today.strftime("%Y-%m-%d")
+    tomorrow_start = (today + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+    
+    with db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(user_id) FROM users")
-        total_users = cursor.fetchone()[0] or 0
-        cursor.execute("SELECT COUNT(user_id) FROM users WHERE is_premium = 1")
-        premium_users = cursor.fetchone()[0] or 0
-        conn.close()
-        return total_users, premium_users
+        query = """
+            SELECT city_code,
+                   COUNT(*),
+                   SUM(CASE WHEN is_premium = 1 THEN 1 ELSE 0 END),
+                   SUM(CASE WHEN created_at >= {p} AND created_at < {p} THEN 1 ELSE 0 END),
+                   SUM(CASE WHEN is_premium = 1 AND created_at >= {p} AND created_at < {p} THEN 1 ELSE 0 END),
+                   SUM(CASE WHEN dead_since IS NOT NULL THEN 1 ELSE 0 END)
+            FROM users
+            GROUP BY city_code
+        """.format(p="%s" if DATABASE_URL else "?")
+        cursor.execute(query, (today_start, tomorrow_start, today_start, tomorrow_start))
+        rows = cursor.fetchall()
+    
+    snapshot = {
+        'total_users': 0,
+        'premium_users': 0,
+        'today_users': 0,
+        'today_premium': 0,
+        'dead_chats': 0,
+        'city_stats': {},
+    }
+    for city_code, total, premium, today_total, today_premium, dead in rows:
+        snapshot['total_users'] += total or 0
+        snapshot['premium_users'] += premium or 0
+        snapshot['today_users'] += today_total or 0
+        snapshot['today_premium'] += today_premium or 0
+        snapshot['dead_chats'] += dead or 0
+        if city_code:
+            city_ar = CITY_AR_BY_CODE.get(city_code, "غير محدد")
+            snapshot['city_stats'][city_ar] = snapshot['city_stats'].get(city_ar, 0) + total
+    
+    snapshot['monthly_revenue'] = snapshot['premium_users'] * 1
+    return snapshot
+
+@timed_db
+def check_expiry_and_update():
+    """فحص وإنهاء الاشتراكات المنتهية وإرجاع عددها"""
+    try:
+        current_date_str = datetime.date.today().strftime("%Y-%m-%d")
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            
+            if DATABASE_URL:
+                cursor.execute("UPDATE users SET is_premium = 0 WHERE end_date <= %s AND is_premium = 1", (current_date_str,))
+            else:
+                cursor.execute("UPDATE users SET is_premium = 0 WHERE end_date <= ? AND is_premium = 1", (current_date_str,))
+            
+            updated_rows = cursor.rowcount
+            conn.commit()
+        logger.info(f"✅ تم إنهاء اشتراك {updated_rows} مستخدمين")
+        return updated_rows
     except Exception as e:
-        logger.error(f"❌ فشل في جلب إحصائيات المستخدمين: {e}")
-        return 0, 0
-    finally:
-        if conn:
-            conn.close()
+        logger.error(f"❌ فشل تحديث الاشتراكات المنتهية: {e}")
+        return 0
+
+@timed_db
+def get_user_by_order(order_id):
+    """الحصول على المستخدم بواسطة رقم الطلب"""
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            
+            if DATABASE_URL:
+                cursor.execute("SELECT user_id FROM users WHERE order_id = %s", (order_id,))
+            else:
+                cursor.execute("SELECT user_id FROM users WHERE order_id = ?", (order_id,))
+            
+            result = cursor.fetchone()
+        return result[0] if result else None
+    except Exception as e:
+        logger.error(f"❌ فشل في جلب المستخدم بواسطة الطلب {order_id}: {e}")
+        return None
 
-def get_daily_stats():
-    """الحصول على إحصائيات اليوم"""
-    conn = None
+@timed_db
+def get_user_city(user_id):
+    """الحصول على مدينة المستخدم"""
     try:
-        today = datetime.date.today().strftime("%Y-%m-%d")
-        conn = get_db_connection()
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            
+            if DATABASE_URL:
+                cursor.execute("SELECT city_code FROM users WHERE user_id = %s", (user_id,))
+            else:
+                cursor.execute("SELECT city_code FROM users WHERE user_id = ?", (user_id,))
+            
+            result = cursor.fetchone()
+        return result[0] if result else None
+    except Exception as e:
+        logger.error(f"❌ فشل في جلب مدينة المستخدم {user_id}: {e}")
+        return None
+
+@timed_db
+def mark_users_dead(user_ids):
+    """تسجيل وقت توقف المحادثة للمستخدمين الذين حظروا البوت أو حذفوا المحادثة"""
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    p = "%s" if DATABASE_URL else "?"
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany(
+            f"UPDATE users SET dead_since = {p} WHERE user_id = {p} AND dead_since IS NULL",
+            [(now, user_id) for user_id in user_ids]
+        )
+        conn.commit()
+
+@timed_db
+def mark_user_alive(user_id):
+    """إلغاء حالة التوقف وإرجاع (is_premium, city_code) للمستخدم"""
+    p = "%s" if DATABASE_URL else "?"
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"UPDATE users SET dead_since = NULL WHERE user_id = {p}", (user_id,))
+        cursor.execute(f"SELECT is_premium, city_code FROM users WHERE user_id = {p}", (user_id,))
+        row = cursor.fetchone()
+        conn.commit()
+    return row
+
+@timed_db
+def get_dead_chat_ids():
+    """معرفات جميع المستخدمين المتوقفين"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT user_id FROM users WHERE dead_since IS NOT NULL")
+        return {row[0] for row in cursor.fetchall()}
+
+@timed_db
+def save_prayer_calendar(city_en, days):
+    """حفظ مواقيت عدة أيام لمدينة في جدول الذاكرة الدائمة دفعة واحدة"""
+    p = "%s" if DATABASE_URL else "?"
+    rows = [
+        (city_en, day.strftime("%Y-%m-%d"), *(timings[key] for key in PRAYER_KEYS))
+        for day, timings in days
+    ]
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany(f"""
+            INSERT INTO prayer_times (city_en, day, fajr, dhuhr, asr, maghrib, isha)
+            VALUES ({p}, {p}, {p}, {p}, {p}, {p}, {p})
+            ON CONFLICT (city_en, day)
+            DO UPDATE SET fajr = excluded.fajr, dhuhr = excluded.dhuhr, asr = excluded.asr,
+                          maghrib = excluded.maghrib, isha = excluded.isha
+        """, rows)
+        conn.commit()
+    return len(rows)
+
+def _timings_from_row(row):
+    return dict(zip(PRAYER_KEYS, row))
+
+@timed_db
+def get_cached_timings(day: datetime.date):
+    """مواقيت جميع المدن المخزنة ليوم محدد"""
+    with db_connection() as conn:
         cursor = conn.cursor()
-        
         if DATABASE_URL:
-            cursor.execute("SELECT COUNT(*) FROM users WHERE DATE(created_at) = %s", (today,))
+            cursor.execute("SELECT city_en, fajr, dhuhr, asr, maghrib, isha FROM prayer_times WHERE day = %s", (day.strftime("%Y-%m-%d"),))
         else:
-            cursor.execute("SELECT COUNT(*) FROM users WHERE DATE(created_at) = ?", (today,))
-        
-        today_users = cursor.fetchone()[0] or 0
-        
+            cursor.execute("SELECT city_en, fajr, dhuhr, asr, maghrib, isha FROM prayer_times WHERE day = ?", (day.strftime("%Y-%m-%d"),))
+        return {row[0]: _timings_from_row(row[1:]) for row in cursor.fetchall()}
+
+@timed_db
+def get_last_known_timings(city_en, day: datetime.date):
+    """آخر مواقيت معروفة لمدينة خلال مدة الصلاحية المسموحة"""
+    oldest = (day - datetime.timedelta(days=PRAYER_CACHE_MAX_STALE_DAYS)).strftime("%Y-%m-%d")
+    with db_connection() as conn:
+        cursor = conn.cursor()
         if DATABASE_URL:
-            cursor.execute("SELECT COUNT(*) FROM users WHERE is_premium = 1 AND DATE(created_at) = %s", (today,))
+            cursor.execute("""
+                SELECT fajr, dhuhr, asr, maghrib, isha FROM prayer_times
+                WHERE city_en = %s AND day <= %s AND day >= %s ORDER BY day DESC LIMIT 1
+            """, (city_en, day.strftime("%Y-%m-%d"), oldest))
         else:
-            cursor.execute("SELECT COUNT(*) FROM users WHERE is_premium = 1 AND DATE(created_at) = ?", (today,))
-        
-        today_premium = cursor.fetchone()[0] or 0
-        
-        conn.close()
-        return today_users, today_premium
-    except Exception as e:
-        logger.error(f"❌ فشل في جلب إحصائيات اليوم: {e}")
-        return 0, 0
-    finally:
-        if conn:
-            conn.close()
+            cursor.execute("""
+                SELECT fajr, dhuhr, asr, maghrib, isha FROM prayer_times
+                WHERE city_en = ? AND day <= ? AND day >= ? ORDER BY day DESC LIMIT 1
+            """, (city_en, day.strftime("%Y-%m-%d"), oldest))
+        row = cursor.fetchone()
+    return _timings_from_row(row) if row else None
 
-def get_city_distribution():
-    """توزيع المستخدمين حسب المحافظة"""
-    conn = None
-    try:
-        conn = get_db_connection()
+@timed_db
+def get_prayer_cache_coverage(start: datetime.date, end: datetime.date):
+    """عدد الأيام المخزنة لكل مدينة ضمن فترة"""
+    with db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT city_url, COUNT(*) FROM users GROUP BY city_url")
-        distribution = cursor.fetchall()
-        conn.close()
-        
-        city_stats = {}
-        for city_url, count in distribution:
-            if city_url:
-                city_ar = get_city_ar_from_url(city_url)
-                city_stats[city_ar] = count
-        
-        return city_stats
-    except Exception as e:
-        logger.error(f"❌ فشل في جلب توزيع المحافظات: {e}")
-        return {}
-    finally:
-        if conn:
-            conn.close()
+        if DATABASE_URL:
+            cursor.execute("""
+                SELECT city_en, COUNT(*) FROM prayer_times
+                WHERE day >= %s AND day <= %s GROUP BY city_en
+            """, (start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")))
+        else:
+            cursor.execute("""
+                SELECT city_en, COUNT(*) FROM prayer_times
+                WHERE day >= ? AND day <= ? GROUP BY city_en
+            """, (start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")))
+        return dict(cursor.fetchall())
 
-def get_monthly_revenue():
-    """الإيرادات الشهرية"""
-    try:
-        total_users, premium_users = get_user_counts()
-        monthly_revenue = premium_users * 1
-        return monthly_revenue
-    except Exception as e:
-        logger.error(f"❌ فشل في حساب الإيرادات: {e}")
-        return 0
+@timed_db
+def purge_old_prayer_times(before: datetime.date):
+    """حذف المواقيت القديمة التي لم تعد مطلوبة"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        if DATABASE_URL:
+            cursor.execute("DELETE FROM prayer_times WHERE day < %s", (before.strftime("%Y-%m-%d"),))
+        else:
+            cursor.execute("DELETE FROM prayer_times WHERE day < ?", (before.strftime("%Y-%m-%d"),))
+        conn.commit()
+        return cursor.rowcount
 
-def check_expiry_and_update():
-    """فحص وإنهاء الاشتراكات المنتهية"""
-    conn = None
-    try:
-        current_date_str = datetime.date.today().strftime("%Y-%m-%d")
-        conn = get_db_connection()
+@timed_db
+def enqueue_outbox(rows):
+    """إضافة رسائل إلى صندوق الصادر دفعة واحدة وتجاهل المكرر حسب مفتاح التكرار
+    
+    rows: قائمة من (user_id, text, label, dedupe_key, due_at, priority)
+    """
+    with db_connection() as conn:
         cursor = conn.cursor()
-        
         if DATABASE_URL:
-            cursor.execute("UPDATE users SET is_premium = 0 WHERE end_date <= %s AND is_premium = 1", (current_date_str,))
+            from psycopg2.extras import execute_values
+            execute_values(cursor, """
+                INSERT INTO outbox (user_id, text, label, dedupe_key, due_at, priority) VALUES %s
+                ON CONFLICT (dedupe_key) DO NOTHING
+            """, rows, page_size=max(len(rows), 1))
         else:
-            cursor.execute("UPDATE users SET is_premium = 0 WHERE end_date <= ? AND is_premium = 1", (current_date_str,))
-        
-        updated_rows = cursor.rowcount
+            cursor.executemany("""
+                INSERT INTO outbox (user_id, text, label, dedupe_key, due_at, priority) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (dedupe_key) DO NOTHING
+            """, rows)
         conn.commit()
-        logger.info(f"✅ تم إنهاء اشتراك {updated_rows} مستخدمين")
-    except Exception as e:
-        logger.error(f"❌ فشل تحديث الاشتراكات المنتهية: {e}")
-    finally:
-        if conn:
-            conn.close()
+        return cursor.rowcount
 
-def get_user_by_order(order_id):
-    """الحصول على المستخدم بواسطة رقم الطلب"""
-    conn = None
-    try:
-        conn = get_db_connection()
+@timed_db
+def is_broadcast_enqueued(dedupe_prefix):
+    """هل سبق إدراج هذا البث في صندوق الصادر"""
+    with db_connection() as conn:
         cursor = conn.cursor()
-        
         if DATABASE_URL:
-            cursor.execute("SELECT user_id FROM users WHERE order_id = %s", (order_id,))
+            cursor.execute("SELECT 1 FROM outbox_broadcasts WHERE dedupe_prefix = %s", (dedupe_prefix,))
         else:
-            cursor.execute("SELECT user_id FROM users WHERE order_id = ?", (order_id,))
-        
-        result = cursor.fetchone()
-        conn.close()
-        return result[0] if result else None
-    except Exception as e:
-        logger.error(f"❌ فشل في جلب المستخدم بواسطة الطلب {order_id}: {e}")
-        return None
-    finally:
-        if conn:
-            conn.close()
+            cursor.execute("SELECT 1 FROM outbox_broadcasts WHERE dedupe_prefix = ?", (dedupe_prefix,))
+        return cursor.fetchone() is not None
 
-def get_user_city(user_id):
-    """الحصول على مدينة المستخدم"""
-    conn = None
-    try:
-        conn = get_db_connection()
+@timed_db
+def record_broadcast_enqueued(dedupe_prefix, queued):
+    """تسجيل اكتمال إدراج بث وحذف سجلات البث الأقدم من يومين"""
+    now = time.time()
+    p = "%s" if DATABASE_URL else "?"
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"INSERT INTO outbox_broadcasts (dedupe_prefix, queued, created_at) VALUES ({p}, {p}, {p}) ON CONFLICT (dedupe_prefix) DO NOTHING",
+            (dedupe_prefix, queued, now)
+        )
+        cursor.execute(f"DELETE FROM outbox_broadcasts WHERE created_at < {p}", (now - 2 * 86400,))
+        conn.commit()
+
+@timed_db
+def claim_outbox_batch(limit, lease_seconds):
+    """حجز دفعة من الرسائل المستحقة حسب الأولوية ثم الموعد لمدة محددة حتى لا يرسلها عامل آخر
+    
+    تُرجع (الصفوف، أقرب موعد لرسالة عاجلة غير محجوزة أو None)
+    """
+    now = time.time()
+    with db_connection() as conn:
         cursor = conn.cursor()
-        
         if DATABASE_URL:
-            cursor.execute("SELECT city_url FROM users WHERE user_id = %s", (user_id,))
+            cursor.execute("""
+                UPDATE outbox SET lease_until = %s, attempts = attempts + 1
+                WHERE id IN (
+                    SELECT id FROM outbox WHERE due_at <= %s AND lease_until < %s
+                    ORDER BY priority, due_at, id LIMIT %s FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, user_id, text, attempts, due_at, priority
+            """, (now + lease_seconds, now, now, limit))
+            rows = cursor.fetchall()
+            cursor.execute(
+                "SELECT MIN(due_at) FROM outbox WHERE priority < %s AND lease_until < %s",
+                (SEND_PRIORITY_CONTENT, now)
+            )
         else:
-            cursor.execute("SELECT city_url FROM users WHERE user_id = ?", (user_id,))
-        
-        result = cursor.fetchone()
-        conn.close()
-        return result[0] if result else None
-    except Exception as e:
-        logger.error(f"❌ فشل في جلب مدينة المستخدم {user_id}: {e}")
-        return None
-    finally:
-        if conn:
-            conn.close()
+            cursor.execute("""
+                SELECT id, user_id, text, attempts + 1, due_at, priority FROM outbox
+                WHERE due_at <= ? AND lease_until < ? ORDER BY priority, due_at, id LIMIT ?
+            """, (now, now, limit))
+            rows = cursor.fetchall()
+            cursor.executemany(
+                "UPDATE outbox SET lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                [(now + lease_seconds, row[0]) for row in rows]
+            )
+            cursor.execute(
+                "SELECT MIN(due_at) FROM outbox WHERE priority < ? AND lease_until < ?",
+                (SEND_PRIORITY_CONTENT, now)
+            )
+        next_urgent_due = cursor.fetchone()[0]
+        conn.commit()
+    return sorted(rows, key=lambda row: (row[5], row[4], row[0])), next_urgent_due
 
-def get_city_ar_from_url(url):
-    """الحصول على اسم المدينة بالعربية من الـ URL"""
-    if not url:
-        return "غير محدد"
-    for ar_name, en_name in SYRIAN_CITIES.items():
-        if en_name in url:
-            return ar_name
-    return "غير محدد"
-
-def get_city_en_from_url(url):
-    """الحصول على اسم المدينة بالإنجليزية من الـ URL"""
-    if not url:
-        return "Damascus"
-    for ar_name, en_name in SYRIAN_CITIES.items():
-        if en_name in url:
-            return en_name
-    return "Damascus"
+@timed_db
+def complete_outbox_batch(done_ids, retry_ids, retry_at, released_ids=()):
+    """حذف الرسائل المنتهية وإعادة جدولة القابلة لإعادة المحاولة وإطلاق المؤجلة لصالح رسائل أهم"""
+    p = "%s" if DATABASE_URL else "?"
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        if done_ids:
+            cursor.executemany(f"DELETE FROM outbox WHERE id = {p}", [(i,) for i in done_ids])
+        if retry_ids:
+            cursor.executemany(
+                f"UPDATE outbox SET due_at = {p}, lease_until = 0 WHERE id = {p}",
+                [(retry_at, i) for i in retry_ids]
+            )
+        if released_ids:
+            cursor.executemany(
+                f"UPDATE outbox SET lease_until = 0, attempts = attempts - 1 WHERE id = {p}",
+                [(i,) for i in released_ids]
+            )
+        conn.commit()
+
+@timed_db
+def get_outbox_stats():
+    """عمق صندوق الصادر وعدد المستحق والمحجوز وعمر أقدم رسالة مستحقة"""
+    now = time.time()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        if DATABASE_URL:
+            cursor.execute("""
+                SELECT COUNT(*),
+                       COUNT(*) FILTER (WHERE due_at <= %s),
+                       COUNT(*) FILTER (WHERE lease_until >= %s),
+                       MIN(due_at)
+                FROM outbox
+            """, (now, now))
+        else:
+            cursor.execute("""
+                SELECT COUNT(*),
+                       COALESCE(SUM(due_at <= ?), 0),
+                       COALESCE(SUM(lease_until >= ?), 0),
+                       MIN(due_at)
+                FROM outbox
+            """, (now, now))
+        depth, due, leased, oldest_due = cursor.fetchone()
+    return {
+        'depth': depth,
+        'due': due,
+        'leased': leased,
+        'oldest_due_age': max(0.0, now - oldest_due) if oldest_due is not None and oldest_due <= now else 0.0,
+        'next_due_in': max(0.0, oldest_due - now) if oldest_due is not None else None,
+    }
 
 def generate_order_id(user_id):
     """إنشاء رقم طلب فريد"""
     return f"{int(time.time())}-{str(user_id)[-4:]}"
 
-def get_weather_data(city_en):
-    """جلب بيانات الطقس"""
+async def fetch_weather_report(city_en):
+    """جلب بيانات الطقس من الخدمة مباشرة"""
+    url = BASE_WEATHER_API.format(city_en=city_en)
+    response = await http_get(url, timeout=10)
+    weather_data = response.text.strip()
+    
+    parts = weather_data.split()
+    if len(parts) >= 4:
+        condition = parts[0]
+        temperature = parts[1]
+        wind = parts[2]
+        humidity = parts[3]
+        
+        city_ar = CITY_AR_BY_EN.get(city_en, city_en)
+        
+        weather_report = (
+            f"🌤️ <b>حالة الطقس في {city_ar}</b>\n\n"
+            f"☁️ <b>الحالة:</b> {condition}\n"
+            f"🌡️ <b>درجة الحرارة:</b> {temperature}\n"
+            f"💨 <b>سرعة الرياح:</b> {wind}\n"
+            f"💧 <b>الرطوبة:</b> {humidity}"
+        )
+        return weather_report
+    else:
+        return f"🌤️ <b>حالة الطقس:</b>\n\n{weather_data}"
+
+async def _refresh_weather(city_en):
+    """تحديث الذاكرة المؤقتة للطقس لمدينة واحدة"""
+    try:
+        weather_report = await fetch_weather_report(city_en)
+        _weather_cache[city_en] = (time.monotonic() + WEATHER_CACHE_TTL, weather_report)
+        return weather_report
+    finally:
+        _weather_inflight.pop(city_en, None)
+
+async def get_weather_data(city_en, force_refresh=False):
+    """جلب بيانات الطقس من الذاكرة المؤقتة، مع طلب واحد مشترك عند الإخفاق المتزامن"""
     try:
-        url = BASE_WEATHER_API.format(city_en=city_en)
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        weather_data = response.text.strip()
+        cached = _weather_cache.get(city_en)
+        if cached and cached[0] > time.monotonic() and not force_refresh:
+            _weather_cache_stats['hits'] += 1
+            return cached[1]
         
-        parts = weather_data.split()
-        if len(parts) >= 4:
-            condition = parts[0]
-            temperature = parts[1]
-            wind = parts[2]
-            humidity = parts[3]
-            
-            city_ar = get_city_ar_from_url(BASE_PRAYER_API.format(city_en=city_en))
-            
-            weather_report = (
-                f"🌤️ <b>حالة الطقس في {city_ar}</b>\n\n"
-                f"☁️ <b>الحالة:</b> {condition}\n"
-                f"🌡️ <b>درجة الحرارة:</b> {temperature}\n"
-                f"💨 <b>سرعة الرياح:</b> {wind}\n"
-                f"💧 <b>الرطوبة:</b> {humidity}"
-            )
-            return weather_report
+        task = _weather_inflight.get(city_en)
+        if task is None:
+            _weather_cache_stats['misses'] += 1
+            task = asyncio.create_task(_refresh_weather(city_en))
+            _weather_inflight[city_en] = task
         else:
-            return f"🌤️ <b>حالة الطقس:</b>\n\n{weather_data}"
+            _weather_cache_stats['coalesced'] += 1
+        return await asyncio.shield(task)
     except Exception as e:
         logger.error(f"❌ فشل جلب بيانات الطقس لـ {city_en}: {e}")
         return f"❌ تعذر جلب بيانات الطقس"
 
+async def prewarm_weather_cache():
+    """تعبئة ذاكرة الطقس لجميع المحافظات قبل البث الصباحي"""
+    await asyncio.gather(
+        *(get_weather_data(city_en, force_refresh=True) for city_en in SYRIAN_CITIES.values())
+    )
+    logger.info(f"🌤️ تم تجهيز الطقس لـ {len(_weather_cache)} محافظة")
+
+def get_weather_cache_stats_line():
+    """سطر إحصائيات ذاكرة الطقس لتقرير الصحة"""
+    return (
+        f"🌤️ <b>ذاكرة الطقس:</b> {_weather_cache_stats['hits']} إصابة، "
+        f"{_weather_cache_stats['misses']} إخفاق، "
+        f"{_weather_cache_stats['coalesced']} مشترك"
+    )
+
+# ==================== لقطة الإحصائيات ====================
+_stats_cache = {'snapshot': None, 'expires': 0.0}
+_stats_lock = None
+
+async def get_stats_snapshot(force_refresh=False):
+    """لقطة إحصائيات مشتركة بين لوحة المالك و /stats و /health لمدة قصيرة"""
+    global _stats_lock
+    if _stats_lock is None:
+        _stats_lock = asyncio.Lock()
+    
+    async with _stats_lock:
+        if not force_refresh and _stats_cache['snapshot'] and _stats_cache['expires'] > time.monotonic():
+            return _stats_cache['snapshot']
+        try:
+            snapshot = await run_db(compute_stats_snapshot)
+        except Exception as e:
+            logger.error(f"❌ فشل في حساب الإحصائيات: {e}")
+            return _stats_cache['snapshot'] or {
+                'total_users': 0, 'premium_users': 0, 'today_users': 0,
+                'today_premium': 0, 'city_stats': {}, 'monthly_revenue': 0,
+                'dead_chats': len(_dead_chats),
+            }
+        _stats_cache['snapshot'] = snapshot
+        _stats_cache['expires'] = time.monotonic() + STATS_CACHE_TTL
+        return snapshot
+
+# ==================== فهرس المشتركين المميزين ====================
+_premium_by_city = defaultdict(set)
+_premium_user_city = {}
+_premium_index_lock = threading.Lock()
+
+def _build_premium_index(users):
+    """بناء الفهرس من صفوف (user_id, city_code)"""
+    by_city = defaultdict(set)
+    user_city = {}
+    for user_id, city_code in users:
+        city_en = CITY_EN_BY_CODE.get(city_code)
+        user_city[user_id] = city_en
+        if city_en:
+            by_city[city_en].add(user_id)
+    return by_city, user_city
+
+def load_premium_index():
+    """تحميل المشتركين المميزين من قاعدة البيانات إلى الذاكرة مجمعين حسب المدينة"""
+    global _premium_by_city, _premium_user_city
+    by_city, user_city = _build_premium_index(get_premium_users())
+    with _premium_index_lock:
+        _premium_by_city = by_city
+        _premium_user_city = user_city
+    logger.info(f"✅ تم تحميل فهرس المشتركين: {len(user_city)} مشترك في {len(by_city)} مدينة")
+
+def add_to_premium_index(user_id, city_en):
+    """إضافة مشترك جديد إلى الفهرس"""
+    with _premium_index_lock:
+        old_city = _premium_user_city.get(user_id)
+        if old_city:
+            _premium_by_city[old_city].discard(user_id)
+        _premium_user_city[user_id] = city_en
+        if city_en:
+            _premium_by_city[city_en].add(user_id)
+
+def update_premium_index_city(user_id, city_en):
+    """نقل مشترك موجود إلى مدينته الجديدة"""
+    with _premium_index_lock:
+        if user_id not in _premium_user_city:
+            return
+    add_to_premium_index(user_id, city_en)
+
+def get_indexed_premium_users():
+    """جميع المشتركين المميزين من الذاكرة كقائمة (user_id, city_en)"""
+    with _premium_index_lock:
+        return list(_premium_user_city.items())
+
+def get_indexed_city_subscribers(city_en):
+    """المشتركون المميزون في مدينة واحدة من الذاكرة"""
+    with _premium_index_lock:
+        return list(_premium_by_city.get(city_en, ()))
+
+def verify_premium_index():
+    """مقارنة الفهرس بقاعدة البيانات وإعادة بنائه عند وجود اختلاف"""
+    global _premium_by_city, _premium_user_city
+    by_city, user_city = _build_premium_index(get_premium_users())
+    with _premium_index_lock:
+        drift = len(set(user_city.items()) ^ set(_premium_user_city.items()))
+        if drift:
+            _premium_by_city = by_city
+            _premium_user_city = user_city
+    if drift:
+        logger.warning(f"⚠️ تم تصحيح {drift} اختلاف بين فهرس المشتركين وقاعدة البيانات")
+
+# ==================== المحادثات المتوقفة ====================
+_dead_chats = set()
+
+def load_dead_chats():
+    """تحميل المستخدمين الذين حظروا البوت إلى الذاكرة"""
+    global _dead_chats
+    _dead_chats = get_dead_chat_ids()
+    logger.info(f"✅ تم تحميل {len(_dead_chats)} محادثة متوقفة")
+
+def remove_from_premium_index(user_id):
+    """حذف مشترك من الفهرس دون تغيير اشتراكه"""
+    with _premium_index_lock:
+        city_en = _premium_user_city.pop(user_id, None)
+        if city_en:
+            _premium_by_city[city_en].discard(user_id)
+
+async def mark_chats_dead(user_ids):
+    """إيقاف الإرسال لمستخدمين حظروا البوت وتسجيل ذلك في قاعدة البيانات"""
+    new_ids = [user_id for user_id in set(user_ids) if user_id not in _dead_chats]
+    if not new_ids:
+        return
+    _dead_chats.update(new_ids)
+    for user_id in new_ids:
+        remove_from_premium_index(user_id)
+    await run_db(mark_users_dead, new_ids)
+    logger.info(f"💤 تم إيقاف الإرسال لـ {len(new_ids)} محادثة متوقفة")
+
+async def reactivate_dead_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """إعادة تفعيل المستخدم المتوقف عند تواصله مع البوت من جديد"""
+    user = update.effective_user
+    if user is None or user.id not in _dead_chats:
+        return
+    _dead_chats.discard(user.id)
+    row = await run_db(mark_user_alive, user.id)
+    if row and row[0] == 1:
+        add_to_premium_index(user.id, CITY_EN_BY_CODE.get(row[1]))
+    logger.info(f"🔄 إعادة تفعيل المحادثة للمستخدم {user.id}")
+
+# ==================== الكتابة المؤجلة ====================
+_pending_city_writes = {}
+_pending_order_writes = {}
+_session_cities = OrderedDict()
+_write_behind_lock = asyncio.Lock()
+_write_behind_wakeup = asyncio.Event()
+_write_behind_task = None
+
+def _remember_session_city(user_id, city_code):
+    _session_cities[user_id] = city_code
+    _session_cities.move_to_end(user_id)
+    if len(_session_cities) > SESSION_CACHE_SIZE:
+        _session_cities.popitem(last=False)
+
+def _wake_write_behind():
+    if len(_pending_city_writes) + len(_pending_order_writes) >= WRITE_BEHIND_MAX_ROWS:
+        _write_behind_wakeup.set()
+
+def queue_user_city(user_id, city_code):
+    """حفظ مدينة المستخدم في الذاكرة فوراً وتأجيل كتابتها إلى الدفعة التالية"""
+    _pending_city_writes[user_id] = city_code
+    _remember_session_city(user_id, city_code)
+    update_premium_index_city(user_id, CITY_EN_BY_CODE.get(city_code))
+    _wake_write_behind()
+
+def queue_user_order(user_id, order_id):
+    """تأجيل كتابة رقم طلب المستخدم إلى الدفعة التالية"""
+    _pending_order_writes[user_id] = order_id
+    _wake_write_behind()
+
+async def get_session_city(user_id):
+    """مدينة المستخدم من الذاكرة، أو من قاعدة البيانات عند عدم وجودها"""
+    city_code = _pending_city_writes.get(user_id) or _session_cities.get(user_id)
+    if city_code is None:
+        city_code = await run_db(get_user_city, user_id)
+        if city_code:
+            _remember_session_city(user_id, city_code)
+    return city_code
+
+async def flush_write_behind():
+    """كتابة كل ما هو معلق في معاملة واحدة؛ تُرجع False وتُبقي الصفوف معلقة عند الفشل"""
+    global _pending_city_writes, _pending_order_writes
+    async with _write_behind_lock:
+        cities, orders = _pending_city_writes, _pending_order_writes
+        if not cities and not orders:
+            return True
+        _pending_city_writes, _pending_order_writes = {}, {}
+        try:
+            await run_db(
+                flush_user_writes,
+                list(cities.items()),
+                [(order_id, user_id) for user_id, order_id in orders.items()]
+            )
+        except Exception as e:
+            # القيم الأحدث التي وصلت أثناء الكتابة لها الأولوية
+            for user_id, city_code in cities.items():
+                _pending_city_writes.setdefault(user_id, city_code)
+            for user_id, order_id in orders.items():
+                _pending_order_writes.setdefault(user_id, order_id)
+            increment_counter('bot_write_behind_rows_total', len(cities) + len(orders), result='error')
+            logger.error(f"❌ فشل في كتابة {len(cities) + len(orders)} صف مؤجل: {e}")
+            return False
+        increment_counter('bot_write_behind_rows_total', len(cities) + len(orders), result='success')
+        return True
+
+async def write_behind_worker():
+    """كتابة المدن والطلبات المعلقة كل WRITE_BEHIND_INTERVAL ثانية أو عند بلوغ WRITE_BEHIND_MAX_ROWS"""
+    while True:
+        try:
+            await asyncio.wait_for(_write_behind_wakeup.wait(), timeout=WRITE_BEHIND_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _write_behind_wakeup.clear()
+        await flush_write_behind()
+
+def start_write_behind():
+    """تشغيل عامل الكتابة المؤجلة كمهمة في الخلفية"""
+    global _write_behind_task
+    if _write_behind_task is None:
+        _write_behind_task = asyncio.create_task(write_behind_worker())
+
+async def stop_write_behind():
+    """إيقاف العامل وكتابة ما تبقى قبل الإغلاق"""
+    global _write_behind_task
+    if _write_behind_task is not None:
+        _write_behind_task.cancel()
+        try:
+            await _write_behind_task
+        except asyncio.CancelledError:
+            pass
+        _write_behind_task = None
+    if not await flush_write_behind():
+        logger.error(f"❌ بقيت {len(_pending_city_writes) + len(_pending_order_writes)} كتابة مؤجلة دون حفظ")
+
 # ==================== معالجات الأوامر ====================
+@timed_handler
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     keyboard = []
@@ -458,6 +1569,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='HTML'
     )
 
+@timed_handler
 async def unified_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """معالج موحد لجميع الأزرار"""
     query = update.callback_query
@@ -497,77 +1609,78 @@ async def unified_callback_handler(update: Update, context: ContextTypes.DEFAULT
 async def handle_city_choice(query, callback_data, user_id):
     """معالجة اختيار المدينة"""
     city_en = callback_data.replace("CITY_CHOICE_", "")
-    final_prayer_url = BASE_PRAYER_API.format(city_en=city_en)
-    city_ar = get_city_ar_from_url(final_prayer_url)
+    city_code = CITY_CODES.get(city_en)
+    if not city_code:
+        await query.edit_message_text("⚠️ أمر غير معروف.", parse_mode='HTML')
+        return
+    city_ar = CITY_AR_BY_CODE[city_code]
+    queue_user_city(user_id, city_code)
     
-    if save_user_city(user_id, final_prayer_url):
-        subscribe_keyboard = InlineKeyboardMarkup([[
-            InlineKeyboardButton("💰 تفعيل الاشتراك الآن", callback_data="ACTIVATE_ORDER")
-        ]])
-        await query.edit_message_text(
-            f"🎉 <b>اختيارك لمحافظة {city_ar} تم بنجاح!</b> 🎉\n\n"
-            f"اضغط على الزر أدناه لبدء عملية الدفع:",
-            reply_markup=subscribe_keyboard,
-            parse_mode='HTML'
-        )
+    subscribe_keyboard = InlineKeyboardMarkup([[
+        InlineKeyboardButton("💰 تفعيل الاشتراك الآن", callback_data="ACTIVATE_ORDER")
+    ]])
+    await query.edit_message_text(
+        f"🎉 <b>اختيارك لمحافظة {city_ar} تم بنجاح!</b> 🎉\n\n"
+        f"اضغط على الزر أدناه لبدء عملية الدفع:",
+        reply_markup=subscribe_keyboard,
+        parse_mode='HTML'
+    )
 
 async def handle_activate_order(query, user_id, context):
     """معالجة طلب تفعيل الاشتراك"""
-    city_url = get_user_city(user_id)
+    city_code = await get_session_city(user_id)
     
-    if not city_url:
+    if not city_code:
         await query.edit_message_text("❌ لم يتم اختيار المحافظة بعد. يرجى البدء من جديد عبر /start.", parse_mode='HTML')
         return
     
     new_order_id = generate_order_id(user_id)
+    queue_user_order(user_id, new_order_id)
     
-    if update_user_order(user_id, new_order_id):
-        city_ar = get_city_ar_from_url(city_url)
-        user = query.from_user
-        
-        username = f"@{user.username}" if user.username else "لا يوجد معرف"
-        full_name = user.full_name or "غير معروف"
-        
-        # إرسال إشعار للمالك
-        owner_notification = (
-            f"🔔 <b>طلب دفع جديد!</b>\n\n"
-            f"👤 <b>الاسم:</b> {full_name}\n"
-            f"📱 <b>المعرف:</b> {username}\n"
-            f"🆔 <b>ID:</b> <code>{user_id}</code>\n"
-            f"🗺️ <b>المحافظة:</b> {city_ar}\n"
-            f"📝 <b>رقم الطلب:</b> <code>{new_order_id}</code>\n\n"
-            f"💰 <b>التفعيل:</b> <code>/as {new_order_id}</code>"
-        )
-        
+    city_ar = CITY_AR_BY_CODE.get(city_code, "غير محدد")
+    user = query.from_user
+    
+    username = f"@{user.username}" if user.username else "لا يوجد معرف"
+    full_name = user.full_name or "غير معروف"
+    
+    # إرسال إشعار للمالك
+    owner_notification = (
+        f"🔔 <b>طلب دفع جديد!</b>\n\n"
+        f"👤 <b>الاسم:</b> {full_name}\n"
+        f"📱 <b>المعرف:</b> {username}\n"
+        f"🆔 <b>ID:</b> <code>{user_id}</code>\n"
+        f"🗺️ <b>المحافظة:</b> {city_ar}\n"
+        f"📝 <b>رقم الطلب:</b> <code>{new_order_id}</code>\n\n"
+        f"💰 <b>التفعيل:</b> <code>/as {new_order_id}</code>"
+    )
+    
+    try:
+        await send_message_timed(context.bot, chat_id=int(OWNER_ID_STR), text=owner_notification, parse_mode='HTML')
+    except Exception as e:
+        logger.error(f"❌ فشل إرسال إشعار للمالك: {e}")
+    
+    # إرسال التعليمات للمستخدم
+    final_message = (
+        f"✅ <b>تم إنشاء طلبك بنجاح!</b>\n\n"
+        f"<b>طلب الخدمة رقم: {new_order_id}</b>\n\n"
+        f"<b>💰 قيمة الاشتراك:</b> 1$\n"
+        f"<b>💳 طريقة الدفع:</b> شام كاش\n\n"
+        f"<b>كود الدفع:</b>\n<code>{PAYMENT_QR_CODE_CONTENT}</code>\n\n"
+        f"<i>بعد الدفع، سيتم تفعيل اشتراكك تلقائياً.</i>"
+    )
+    
+    await query.edit_message_text(final_message, parse_mode='HTML')
+    
+    # إرسال صورة QR Code
+    if QR_CODE_IMAGE_FILE_ID:
         try:
-            await context.bot.send_message(chat_id=int(OWNER_ID_STR), text=owner_notification, parse_mode='HTML')
+            await context.bot.send_photo(
+                chat_id=user_id,
+                photo=QR_CODE_IMAGE_FILE_ID,
+                caption="رمز QR للدفع عبر شام كاش"
+            )
         except Exception as e:
-            logger.error(f"❌ فشل إرسال إشعار للمالك: {e}")
-        
-        # إرسال التعليمات للمستخدم
-        final_message = (
-            f"✅ <b>تم إنشاء طلبك بنجاح!</b>\n\n"
-            f"<b>طلب الخدمة رقم: {new_order_id}</b>\n\n"
-            f"<b>💰 قيمة الاشتراك:</b> 1$\n"
-            f"<b>💳 طريقة الدفع:</b> شام كاش\n\n"
-            f"<b>كود الدفع:</b>\n<code>{PAYMENT_QR_CODE_CONTENT}</code>\n\n"
-            f"<i>بعد الدفع، سيتم تفعيل اشتراكك تلقائياً.</i>"
-        )
-        
-        await query.edit_message_text(final_message, parse_mode='HTML')
-        
-        # إرسال صورة QR Code
-        if QR_CODE_IMAGE_FILE_ID:
-            try:
-                await context.bot.send_photo(
-                    chat_id=user_id,
-                    photo=QR_CODE_IMAGE_FILE_ID,
-                    caption="رمز QR للدفع عبر شام كاش"
-                )
-            except Exception as e:
-                logger.error(f"❌ فشل إرسال صورة QR: {e}")
-    else:
-        await query.edit_message_text("❌ حدث خطأ في إنشاء رقم الطلب.", parse_mode='HTML')
+            logger.error(f"❌ فشل إرسال صورة QR: {e}")
 
 async def handle_admin_button(query, callback_data, context):
     """معالجة أزرار المالك"""
@@ -592,9 +1705,10 @@ async def handle_admin_button(query, callback_data, context):
 
 async def send_basic_stats(query):
     """إرسال إحصائيات أساسية"""
-    total_users, premium_users = get_user_counts()
-    today_users, today_premium = get_daily_stats()
-    monthly_revenue = get_monthly_revenue()
+    stats = await get_stats_snapshot()
+    total_users, premium_users = stats['total_users'], stats['premium_users']
+    today_users, today_premium = stats['today_users'], stats['today_premium']
+    monthly_revenue = stats['monthly_revenue']
     
     report = (
         f"📊 <b>الإحصائيات الأساسية</b>\n\n"
@@ -608,10 +1722,11 @@ async def send_basic_stats(query):
 
 async def send_detailed_stats(query):
     """إرسال إحصائيات مفصلة"""
-    total_users, premium_users = get_user_counts()
-    today_users, today_premium = get_daily_stats()
-    monthly_revenue = get_monthly_revenue()
-    city_stats = get_city_distribution()
+    stats = await get_stats_snapshot()
+    total_users, premium_users = stats['total_users'], stats['premium_users']
+    today_users, today_premium = stats['today_users'], stats['today_premium']
+    monthly_revenue = stats['monthly_revenue']
+    city_stats = stats['city_stats']
     
     premium_rate = (premium_users / total_users * 100) if total_users > 0 else 0
     
@@ -642,8 +1757,9 @@ async def send_detailed_stats(query):
 
 async def send_finance_stats(query):
     """إرسال إحصائيات مالية"""
-    total_users, premium_users = get_user_counts()
-    monthly_revenue = get_monthly_revenue()
+    stats = await get_stats_snapshot()
+    total_users, premium_users = stats['total_users'], stats['premium_users']
+    monthly_revenue = stats['monthly_revenue']
     daily_revenue = monthly_revenue / 30
     
     report = (
@@ -663,8 +1779,9 @@ async def send_finance_stats(query):
 
 async def send_geo_stats(query):
     """إرسال إحصائيات جغرافية"""
-    city_stats = get_city_distribution()
-    total_users, _ = get_user_counts()
+    stats = await get_stats_snapshot()
+    city_stats = stats['city_stats']
+    total_users = stats['total_users']
     
     if not city_stats:
         await query.edit_message_text("📭 لا توجد بيانات جغرافية متاحة.", parse_mode='HTML')
@@ -680,41 +1797,67 @@ async def send_geo_stats(query):
         report += f"<b>{city}:</b> {count} مستخدم\n{bar} {percentage:.1f}%\n\n"
     
     await query.edit_message_text(report, parse_mode='HTML')
-
-async def send_health_report(query):
-    """إرسال تقرير صحة البوت"""
+
+async def build_health_report(probe_apis=False):
+    """تقرير صحة البوت من فحص القاعدة والمقاييس المسجلة"""
     report_lines = []
     report_lines.append("🏥 <b>تقرير صحة البوت</b>")
     report_lines.append("=" * 30)
     
     try:
-        conn = get_db_connection()
+        await run_db(check_db_connection)
         if DATABASE_URL:
             report_lines.append("🗄️ <b>قاعدة البيانات:</b> ✅ PostgreSQL")
         else:
-            report_lines.append("🗄️ <b>قاعدة البيانات:</b> ✅ SQLite")
-        conn.close()
+            mode = f"WAL، {len(_sqlite_connections)} اتصال دائم" if SQLITE_PERSISTENT else "اتصال لكل استدعاء"
+            report_lines.append(f"🗄️ <b>قاعدة البيانات:</b> ✅ SQLite ({mode})")
     except Exception as e:
         report_lines.append(f"🗄️ <b>قاعدة البيانات:</b> ❌ خطأ")
     
-    try:
-        test_url = BASE_PRAYER_API.format(city_en="Damascus")
-        response = requests.get(test_url, timeout=5)
-        if response.status_code == 200:
+    pool_stats = get_db_pool_stats()
+    if pool_stats:
+        report_lines.append(
+            f"🔌 <b>مجمع الاتصالات:</b> {pool_stats['in_use']} مستخدم، "
+            f"{pool_stats['idle']} خامل، الحد {pool_stats['max']}"
+        )
+    
+    if probe_apis:
+        try:
+            test_url = BASE_PRAYER_API.format(city_en="Damascus")
+            await http_get(test_url, timeout=5, retries=0)
             report_lines.append("🕌 <b>API الأذان:</b> ✅ يعمل")
-        else:
+        except httpx.HTTPStatusError:
             report_lines.append("🕌 <b>API الأذان:</b> ⚠️ مشكلة")
-    except:
-        report_lines.append("🕌 <b>API الأذان:</b> ❌ غير متصل")
+        except:
+            report_lines.append("🕌 <b>API الأذان:</b> ❌ غير متصل")
+    
+    report_lines.append(get_weather_cache_stats_line())
+    report_lines.append(get_update_latency_line())
+    report_lines.extend(get_metrics_health_lines())
     
-    total_users, premium_users = get_user_counts()
+    try:
+        outbox_stats = await run_db(get_outbox_stats)
+        report_lines.append(
+            f"📬 <b>صندوق الصادر:</b> {outbox_stats['depth']} معلقة، {outbox_stats['due']} مستحقة، "
+            f"أقدمها متأخرة {outbox_stats['oldest_due_age']:.0f} ثانية"
+        )
+    except Exception:
+        report_lines.append("📬 <b>صندوق الصادر:</b> ❌ خطأ")
+    
+    stats = await get_stats_snapshot()
+    total_users, premium_users = stats['total_users'], stats['premium_users']
     report_lines.append(f"📊 <b>المستخدمين:</b> {total_users} ({premium_users} مميز)")
+    report_lines.append(f"💤 <b>محادثات متوقفة:</b> {stats['dead_chats']}")
     
     now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     report_lines.append(f"🕐 <b>الوقت:</b> {now}")
-    
-    await query.edit_message_text("\n".join(report_lines), parse_mode='HTML')
+    return "\n".join(report_lines)
 
+async def send_health_report(query):
+    """إرسال تقرير صحة البوت"""
+    await query.edit_message_text(await build_health_report(probe_apis=True), parse_mode='HTML')
+
+@timed_handler
 async def confirm_payment_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != int(OWNER_ID_STR):
         await update.message.reply_text("❌ هذا الأمر للمالك فقط.", parse_mode='HTML')
@@ -723,14 +1866,19 @@ async def confirm_payment_command(update: Update, context: ContextTypes.DEFAULT_
         await update.message.reply_text("⚠️ يرجى تحديد رقم الطلب: <code>/as &lt;رقم_الطلب&gt;</code>", parse_mode='HTML')
         return
     order_id = context.args[0]
-    user_id = get_user_by_order(order_id)
+    # الطلب قد يكون ما زال في الكتابة المؤجلة؛ لا يُفعّل اشتراك قبل حفظه
+    if not await flush_write_behind():
+        await update.message.reply_text("❌ تعذر حفظ الطلبات المعلقة، يرجى المحاولة مرة أخرى.", parse_mode='HTML')
+        return
+    user_id = await run_db(get_user_by_order, order_id)
     if not user_id:
         await update.message.reply_text(f"❌ لم يتم العثور على طلب: {order_id}", parse_mode='HTML')
         return
     
-    if activate_premium(user_id, order_id):
+    if await run_db(activate_premium, user_id, order_id):
         try:
-            await context.bot.send_message(
+            await send_message_timed(
+                context.bot,
                 chat_id=user_id,
                 text=f"✅ <b>تم تفعيل اشتراكك بنجاح!</b>\n\nطلب رقم: {order_id}\nستصلك الإشعارات تلقائياً.",
                 parse_mode='HTML'
@@ -742,13 +1890,15 @@ async def confirm_payment_command(update: Update, context: ContextTypes.DEFAULT_
     else:
         await update.message.reply_text(f"❌ فشل في تفعيل الاشتراك.", parse_mode='HTML')
 
+@timed_handler
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != int(OWNER_ID_STR):
         await update.message.reply_text("❌ هذا الأمر للمالك فقط.", parse_mode='HTML')
         return
-    total_users, premium_users = get_user_counts()
-    today_users, today_premium = get_daily_stats()
-    monthly_revenue = get_monthly_revenue()
+    stats = await get_stats_snapshot()
+    total_users, premium_users = stats['total_users'], stats['premium_users']
+    today_users, today_premium = stats['today_users'], stats['today_premium']
+    monthly_revenue = stats['monthly_revenue']
     
     report = (
         f"📊 <b>الإحصائيات الأساسية</b>\n\n"
@@ -760,43 +1910,26 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     await update.message.reply_text(report, parse_mode='HTML')
 
+@timed_handler
 async def weather_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    city_url = get_user_city(user_id)
-    if not city_url:
+    city_code = await get_session_city(user_id)
+    city_en = CITY_EN_BY_CODE.get(city_code)
+    if not city_en:
         await update.message.reply_text("❌ يرجى اختيار المحافظة أولاً عبر /start")
         return
-    city_en = get_city_en_from_url(city_url)
-    weather_report = get_weather_data(city_en)
+    weather_report = await get_weather_data(city_en)
     await update.message.reply_text(weather_report, parse_mode='HTML')
 
+@timed_handler
 async def health_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != int(OWNER_ID_STR):
         await update.message.reply_text("❌ هذا الأمر للمالك فقط.", parse_mode='HTML')
         return
     
-    report_lines = []
-    report_lines.append("🏥 <b>تقرير صحة البوت</b>")
-    report_lines.append("=" * 30)
-    
-    try:
-        conn = get_db_connection()
-        if DATABASE_URL:
-            report_lines.append("🗄️ <b>قاعدة البيانات:</b> ✅ PostgreSQL")
-        else:
-            report_lines.append("🗄️ <b>قاعدة البيانات:</b> ✅ SQLite")
-        conn.close()
-    except Exception as e:
-        report_lines.append(f"🗄️ <b>قاعدة البيانات:</b> ❌ خطأ")
-    
-    total_users, premium_users = get_user_counts()
-    report_lines.append(f"📊 <b>المستخدمين:</b> {total_users} ({premium_users} مميز)")
-    
-    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    report_lines.append(f"🕐 <b>الوقت:</b> {now}")
-    
-    await update.message.reply_text("\n".join(report_lines), parse_mode='HTML')
+    await update.message.reply_text(await build_health_report(), parse_mode='HTML')
 
+@timed_handler
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """لوحة تحكم المالك"""
     if update.effective_user.id != int(OWNER_ID_STR):
@@ -821,6 +1954,7 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='HTML'
     )
 
+@timed_handler
 async def get_file_id_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != int(OWNER_ID_STR):
         await update.message.reply_text("❌ هذا الأمر للمالك فقط.", parse_mode='HTML')
@@ -835,37 +1969,481 @@ async def get_file_id_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
     await update.message.reply_text(f"✅ <b>File ID:</b>\n<code>{photo_file_id}</code>", parse_mode='HTML')
 
-# ==================== دوال الجدولة ====================
-async def send_single_prayer_notification(application: Application, user_id: int, prayer_name: str, city_name_ar: str):
-    try:
-        await application.bot.send_message(
-            chat_id=user_id,
-            text=f"🕋 <b>الله أكبر، الله أكبر.</b> حان الآن وقت صلاة <b>{prayer_name}</b> في محافظة <b>{city_name_ar}</b>.",
-            parse_mode='HTML'
+# ==================== حساب مواقيت الصلاة محلياً ====================
+# إعادة إنتاج طريقة أم القرى (method=4 في aladhan): الفجر 18.5°، العشاء بعد المغرب
+# بـ 90 دقيقة (120 في رمضان)، العصر على المذهب الشافعي، والشروق/الغروب عند 0.833°.
+CITY_COORDINATES = {
+    "Damascus": (33.5138, 36.2765), "Aleppo": (36.2021, 37.1343),
+    "Homs": (34.7324, 36.7137), "Hama": (35.1318, 36.7578),
+    "Latakia": (35.5317, 35.7901), "Tartus": (34.8890, 35.8866),
+    "Deir Ez-Zor": (35.3359, 40.1408), "Raqqa": (35.9594, 39.0079),
+    "Al-Hasakah": (36.5024, 40.7477), "Daraa": (32.6189, 36.1021),
+    "As-Suwayda": (32.7090, 36.5695), "Quneitra": (33.1260, 35.8240),
+    "Idlib": (35.9306, 36.6339), "Rif Dimashq": (33.5167, 36.9500),
+}
+PRAYER_KEYS = ('Fajr', 'Dhuhr', 'Asr', 'Maghrib', 'Isha')
+UMM_AL_QURA_FAJR_ANGLE = 18.5
+UMM_AL_QURA_ISHA_MINUTES = 90
+UMM_AL_QURA_RAMADAN_ISHA_MINUTES = 120
+SUNSET_ANGLE = 0.833
+
+_prayer_timetables = {}
+
+def _hijri_month(day: datetime.date):
+    """الشهر الهجري بالتقويم الجدولي (يكفي لتحديد رمضان)"""
+    l = day.toordinal() + 1721425 - 1948440 + 10632
+    n = (l - 1) // 10631
+    l = l - 10631 * n + 354
+    j = ((10985 - l) // 5316) * ((50 * l) // 17719) + (l // 5670) * ((43 * l) // 15238)
+    l = l - ((30 - j) // 15) * ((17719 * j) // 50) - (j // 16) * ((15238 * j) // 43) + 29
+    return (24 * l) // 709
+
+def _sun_position(jd):
+    """ميل الشمس ومعادلة الزمن لليوم اليولياني"""
+    d = jd - 2451545.0
+    g = math.radians((357.529 + 0.98560028 * d) % 360)
+    q = (280.459 + 0.98564736 * d) % 360
+    l = math.radians((q + 1.915 * math.sin(g) + 0.020 * math.sin(2 * g)) % 360)
+    e = math.radians(23.439 - 0.00000036 * d)
+    ra = (math.degrees(math.atan2(math.cos(e) * math.sin(l), math.cos(l))) / 15) % 24
+    eqt = q / 15 - ra
+    eqt = (eqt + 12) % 24 - 12
+    decl = math.asin(math.sin(e) * math.sin(l))
+    return decl, eqt
+
+def _day_prayer_minutes(jd, lat, lng, utc_offset, isha_minutes):
+    """مواقيت يوم واحد بالدقائق منذ منتصف الليل المحلي"""
+    phi = math.radians(lat)
+    
+    def mid_day(t):
+        return 12 - _sun_position(jd + t)[1]
+    
+    def angle_time(angle, t, before_noon):
+        decl = _sun_position(jd + t)[0]
+        cos_h = (-math.sin(math.radians(angle)) - math.sin(decl) * math.sin(phi)) / (math.cos(decl) * math.cos(phi))
+        hour_angle = math.degrees(math.acos(max(-1.0, min(1.0, cos_h)))) / 15
+        return mid_day(t) + (-hour_angle if before_noon else hour_angle)
+    
+    def asr_time(t):
+        decl = _sun_position(jd + t)[0]
+        angle = -math.degrees(math.atan(1 / (1 + math.tan(abs(phi - decl)))))
+        return angle_time(angle, t, False)
+    
+    fajr = angle_time(UMM_AL_QURA_FAJR_ANGLE, 5 / 24, True)
+    dhuhr = mid_day(12 / 24)
+    asr = asr_time(13 / 24)
+    maghrib = angle_time(SUNSET_ANGLE, 18 / 24, False)
+    isha = maghrib + isha_minutes / 60
+    
+    shift = utc_offset - lng / 15
+    return [int(((hours + shift) * 60 + 0.5) // 1) % 1440 for hours in (fajr, dhuhr, asr, maghrib, isha)]
+
+def calculate_prayer_timetable(city_en, year):
+    """حساب مواقيت سنة كاملة لمدينة في تمريرة واحدة وتخزينها مضغوطة (5 أعداد لكل يوم)"""
+    lat, lng = CITY_COORDINATES[city_en]
+    tz = BOT_TIMEZONE
+    timetable = array('H')
+    day = datetime.date(year, 1, 1)
+    while day.year == year:
+        jd = day.toordinal() + 1721424.5 - lng / (15 * 24)
+        utc_offset = datetime.datetime(day.year, day.month, day.day, 12, tzinfo=tz).utcoffset().total_seconds() / 3600
+        isha_minutes = UMM_AL_QURA_RAMADAN_ISHA_MINUTES if _hijri_month(day) == 9 else UMM_AL_QURA_ISHA_MINUTES
+        timetable.extend(_day_prayer_minutes(jd, lat, lng, utc_offset, isha_minutes))
+        day += datetime.timedelta(days=1)
+    return timetable
+
+def get_offline_timings(city_en, day: datetime.date):
+    """مواقيت الصلاة ليوم محدد من الجدول المحسوب مسبقاً بصيغة aladhan (HH:MM)"""
+    if city_en not in CITY_COORDINATES:
+        return None
+    key = (city_en, day.year)
+    if key not in _prayer_timetables:
+        _prayer_timetables[key] = calculate_prayer_timetable(city_en, day.year)
+    offset = (day.timetuple().tm_yday - 1) * len(PRAYER_KEYS)
+    minutes = _prayer_timetables[key][offset:offset + len(PRAYER_KEYS)]
+    return {key_en: f"{m // 60:02d}:{m % 60:02d}" for key_en, m in zip(PRAYER_KEYS, minutes)}
+
+# ==================== محرك البث ====================
+class TokenBucket:
+    """دلو رموز بسيط لتحديد معدل العمليات في الثانية"""
+    
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    async def acquire(self):
+        """انتظار رمز متاح ثم استهلاكه"""
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+    
+    def try_acquire(self):
+        """استهلاك رمز إن توفر دون انتظار"""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+_global_send_bucket = TokenBucket(BROADCAST_GLOBAL_RATE)
+_chat_last_sent = {}
+_send_paused_until = 0.0
+
+async def _wait_for_send_slot(chat_id):
+    """احترام حد Telegram العام والحد الخاص بكل محادثة وأي إيقاف مؤقت بسبب 429"""
+    while True:
+        pause = _send_paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+            continue
+        chat_wait = _chat_last_sent.get(chat_id, 0) + BROADCAST_PER_CHAT_INTERVAL - time.monotonic()
+        if chat_wait > 0:
+            await asyncio.sleep(chat_wait)
+            continue
+        break
+    await _global_send_bucket.acquire()
+    _chat_last_sent[chat_id] = time.monotonic()
+
+def _prune_chat_last_sent():
+    """حذف سجلات المحادثات القديمة لإبقاء الذاكرة محدودة"""
+    threshold = time.monotonic() - BROADCAST_PER_CHAT_INTERVAL
+    for chat_id in [c for c, t in _chat_last_sent.items() if t < threshold]:
+        del _chat_last_sent[chat_id]
+
+async def send_message_with_retry(bot, chat_id, text, stats):
+    """إرسال رسالة واحدة مع احترام RetryAfter وإعادة المحاولة عند أخطاء الشبكة
+    
+    تُرجع 'sent' أو 'dead' (حظر أو محادثة غير موجودة) أو 'rejected' (لا فائدة من الإعادة) أو 'failed' (يمكن الإعادة لاحقاً)
+    """
+    global _send_paused_until
+    for attempt in range(BROADCAST_MAX_RETRIES + 1):
+        await _wait_for_send_slot(chat_id)
+        try:
+            await send_message_timed(bot, chat_id=chat_id, text=text, parse_mode='HTML')
+            stats['sent'] += 1
+            return 'sent'
+        except RetryAfter as e:
+            stats['retry_after'] += 1
+            _send_paused_until = max(_send_paused_until, time.monotonic() + float(e.retry_after))
+            logger.warning(f"⚠️ تجاوز حد Telegram، إيقاف الإرسال {e.retry_after} ثانية")
+        except Forbidden:
+            stats['forbidden'] += 1
+            return 'dead'
+        except BadRequest as e:
+            if 'chat not found' in str(e).lower():
+                stats['forbidden'] += 1
+                return 'dead'
+            logger.warning(f"⚠️ رسالة مرفوضة للمستخدم {chat_id}: {e}")
+            stats['failed'] += 1
+            return 'rejected'
+        except NetworkError as e:
+            if attempt < BROADCAST_MAX_RETRIES:
+                await asyncio.sleep(HTTP_BACKOFF_BASE * (2 ** attempt))
+        except Exception as e:
+            logger.error(f"❌ خطأ غير متوقع في الإرسال للمستخدم {chat_id}: {e}")
+            break
+    stats['failed'] += 1
+    return 'failed'
+
+# ==================== تحديد معدل التحديثات ====================
+THROTTLE_RULES = {
+    'command': (THROTTLE_COMMAND_RATE, THROTTLE_COMMAND_BURST),
+    'callback': (THROTTLE_CALLBACK_RATE, THROTTLE_CALLBACK_BURST),
+    'order': (THROTTLE_ORDER_RATE, THROTTLE_ORDER_BURST),
+}
+_throttle_buckets = OrderedDict()  # (user_id, action) -> TokenBucket مرتبة حسب آخر استخدام
+_global_update_bucket = TokenBucket(THROTTLE_GLOBAL_RATE, THROTTLE_GLOBAL_RATE * 2)
+
+def classify_update_action(update: Update):
+    """نوع التحديث المستخدم لاختيار حد المعدل، أو None إن لم يكن خاضعاً للحد"""
+    if update.callback_query:
+        return 'order' if update.callback_query.data == "ACTIVATE_ORDER" else 'callback'
+    if update.message and update.message.text and update.message.text.startswith('/'):
+        return 'command'
+    return None
+
+def _expire_throttle_buckets(now):
+    """حذف الدلاء الخاملة من الأقدم استخداماً مع حد أقصى لعددها"""
+    while _throttle_buckets:
+        bucket = next(iter(_throttle_buckets.values()))
+        if now - bucket.updated < THROTTLE_IDLE_SECONDS and len(_throttle_buckets) <= THROTTLE_MAX_BUCKETS:
+            break
+        _throttle_buckets.popitem(last=False)
+
+def allow_update(user_id, action):
+    """فحص حد المستخدم ثم الحد العام؛ تُرجع None عند السماح أو نطاق الرفض"""
+    key = (user_id, action)
+    bucket = _throttle_buckets.get(key)
+    if bucket is None:
+        rate, burst = THROTTLE_RULES[action]
+        bucket = _throttle_buckets[key] = TokenBucket(rate, burst)
+        _expire_throttle_buckets(time.monotonic())
+    else:
+        _throttle_buckets.move_to_end(key)
+    if not bucket.try_acquire():
+        return 'user'
+    if not _global_update_bucket.try_acquire():
+        return 'global'
+    return None
+
+async def throttle_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """رفض التحديثات المتكررة قبل وصولها للمعالجات"""
+    user = update.effective_user
+    action = classify_update_action(update)
+    if user is None or action is None or user.id == int(OWNER_ID_STR):
+        return
+    scope = allow_update(user.id, action)
+    if scope is None:
+        return
+    increment_counter('bot_throttled_updates_total', action=action, scope=scope)
+    if update.callback_query:
+        try:
+            await update.callback_query.answer("⏳ يرجى الانتظار قليلاً قبل المحاولة مرة أخرى.")
+        except Exception:
+            pass
+    raise ApplicationHandlerStop
+
+# ==================== صندوق الصادر ====================
+_outbox_task = None
+_outbox_wakeup = asyncio.Event()
+_outbox_stopping = asyncio.Event()
+_outbox_urgent_due = None  # أقرب موعد لرسالة صلاة معلقة؛ عند حلوله يتوقف إرسال المحتوى العادي
+
+def _note_urgent_due(due_at):
+    global _outbox_urgent_due
+    if due_at is not None and (_outbox_urgent_due is None or due_at < _outbox_urgent_due):
+        _outbox_urgent_due = due_at
+
+def _urgent_pending():
+    return _outbox_urgent_due is not None and time.time() >= _outbox_urgent_due
+
+def coalesce_texts(texts, followup_delay: float, priorities):
+    """دمج نصوص المستخدم المستحقة خلال MESSAGE_COALESCE_WINDOW في رسالة HTML واحدة
+    
+    تُرجع قائمة من (ترتيب أول نص، النص، الأولوية) دون تجاوز حد طول رسائل Telegram
+    """
+    merged = []
+    for i, text in enumerate(texts):
+        priority = priorities[min(i, len(priorities) - 1)]
+        if merged:
+            first, combined, group_priority = merged[-1]
+            if ((i - first) * followup_delay <= MESSAGE_COALESCE_WINDOW
+                    and len(combined) + 2 + len(text) <= TELEGRAM_MESSAGE_LIMIT):
+                merged[-1] = (first, f"{combined}\n\n{text}", min(group_priority, priority))
+                continue
+        merged.append((i, text, priority))
+    return merged
+
+async def enqueue_broadcast(deliveries, label: str, dedupe_prefix: str, followup_delay: float = 0,
+                            priorities=(SEND_PRIORITY_CONTENT,)):
+    """إضافة رسائل البث إلى صندوق الصادر بدلاً من إرسالها مباشرة
+    
+    deliveries: قائمة من (user_id, [نص1، نص2، ...]) تُستحق نصوص كل مستخدم بفاصل followup_delay
+    dedupe_prefix: يميز هذا البث حتى لا تتكرر رسائله إذا أعيد تشغيل المهمة
+    priorities: أولوية كل نص حسب ترتيبه، والأخيرة لما بعدها
+    عند تفعيل MESSAGE_COALESCE_WINDOW تُدمج النصوص المتقاربة في رسالة واحدة لتقليل استدعاءات Bot API
+    """
+    if await run_db(is_broadcast_enqueued, dedupe_prefix):
+        logger.info(f"ℹ️ بث {label} مدرج مسبقاً في صندوق الصادر، تم تجاهله")
+        return 0
+    now = time.time()
+    rows = [
+        (user_id, text, label, f"{dedupe_prefix}:{user_id}:{i}", now + i * followup_delay, priority)
+        for user_id, texts in deliveries
+        for i, text, priority in (
+            coalesce_texts(texts, followup_delay, priorities) if MESSAGE_COALESCE_WINDOW > 0
+            else ((i, text, priorities[min(i, len(priorities) - 1)]) for i, text in enumerate(texts))
         )
-        
-        await asyncio.sleep(3)
-        azkar_message = random.choice(AZKAR_AFTER_PRAYER)
-        await application.bot.send_message(chat_id=user_id, text=azkar_message, parse_mode='HTML')
-        
-    except Exception as e:
-        logger.warning(f"⚠️ فشل إرسال إشعار صلاة للمستخدم {user_id}: {e}")
+    ]
+    queued = 0
+    for start in range(0, len(rows), 5000):
+        queued += await run_db(enqueue_outbox, rows[start:start + 5000])
+    await run_db(record_broadcast_enqueued, dedupe_prefix, queued)
+    increment_counter('bot_outbox_enqueued_total', queued)
+    urgent = [row[4] for row in rows if row[5] < SEND_PRIORITY_CONTENT]
+    if urgent:
+        _note_urgent_due(min(urgent))
+    _outbox_wakeup.set()
+    logger.info(f"📥 بث {label}: {queued} رسالة في صندوق الصادر لـ {len(deliveries)} مستخدم")
+    return queued
+
+async def deliver_outbox_batch(application: Application, rows):
+    """إرسال دفعة محجوزة حسب الأولوية بترتيب رسائل كل مستخدم وتزامن محدود بين المستخدمين
+    
+    تُسجل الرسائل المنتهية كل OUTBOX_ACK_INTERVAL ثانية حتى لا يُعاد إرسال إلا القليل بعد انقطاع مفاجئ،
+    ويُطلق ما تبقى من المحتوى العادي فور استحقاق رسالة صلاة ليُرسل بعدها
+    """
+    stats = {'sent': 0, 'failed': 0, 'forbidden': 0, 'retry_after': 0, 'preempted': 0}
+    tiers = defaultdict(lambda: defaultdict(list))
+    for row in rows:
+        tiers[row[5]][row[1]].append(row)
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    done_ids, retry_ids, released_ids, dead_ids = [], [], [], []
+    
+    async def flush():
+        nonlocal done_ids, retry_ids, released_ids
+        done, retry, released = done_ids, retry_ids, released_ids
+        done_ids, retry_ids, released_ids = [], [], []
+        if done or retry or released:
+            await run_db(complete_outbox_batch, done, retry, time.time() + OUTBOX_RETRY_DELAY, released)
+    
+    async def flush_periodically():
+        while True:
+            await asyncio.sleep(OUTBOX_ACK_INTERVAL)
+            await flush()
+    
+    async def deliver_user(user_id, user_rows):
+        if user_id in _dead_chats:
+            increment_counter('bot_outbox_completed_total', len(user_rows), result='skipped_dead')
+            done_ids.extend(row[0] for row in user_rows)
+            return
+        async with semaphore:
+            for i, (outbox_id, _, text, attempts, due_at, priority) in enumerate(user_rows):
+                if priority >= SEND_PRIORITY_CONTENT and _urgent_pending():
+                    released_ids.extend(row[0] for row in user_rows[i:])
+                    stats['preempted'] += len(user_rows) - i
+                    return
+                outcome = await send_message_with_retry(application.bot, user_id, text, stats)
+                increment_counter('bot_outbox_completed_total', result=outcome)
+                if outcome == 'sent':
+                    observe_histogram(
+                        'bot_outbox_lateness_seconds', max(0.0, time.time() - due_at),
+                        priority=SEND_PRIORITY_NAMES.get(priority, 'content')
+                    )
+                if outcome == 'dead':
+                    dead_ids.append(user_id)
+                    done_ids.extend(row[0] for row in user_rows[i:])
+                    return
+                if outcome == 'failed':
+                    if attempts < OUTBOX_MAX_ATTEMPTS:
+                        retry_ids.extend(row[0] for row in user_rows[i:])
+                        return
+                    logger.warning(f"⚠️ إسقاط رسالة للمستخدم {user_id} بعد {attempts} محاولات")
+                done_ids.append(outbox_id)
+    
+    flusher = asyncio.create_task(flush_periodically())
+    try:
+        for priority in sorted(tiers):
+            await asyncio.gather(*(
+                deliver_user(user_id, user_rows) for user_id, user_rows in tiers[priority].items()
+            ))
+    finally:
+        flusher.cancel()
+        await flush()
+    await mark_chats_dead(dead_ids)
+    _prune_chat_last_sent()
+    return stats
+
+async def outbox_worker(application: Application):
+    """سحب الرسائل المستحقة من صندوق الصادر وإرسالها دفعة بعد دفعة"""
+    global _outbox_urgent_due
+    logger.info("✅ تم تشغيل عامل صندوق الصادر")
+    while not _outbox_stopping.is_set():
+        _outbox_wakeup.clear()
+        try:
+            rows, next_urgent_due = await run_db(claim_outbox_batch, OUTBOX_BATCH_SIZE, OUTBOX_LEASE_SECONDS)
+            _outbox_urgent_due = next_urgent_due
+            if rows:
+                started = time.monotonic()
+                stats = await deliver_outbox_batch(application, rows)
+                elapsed = time.monotonic() - started
+                logger.info(
+                    f"📤 صندوق الصادر: {stats['sent']} رسالة خلال {elapsed:.1f} ثانية "
+                    f"({stats['sent'] / elapsed if elapsed > 0 else 0:.1f} رسالة/ثانية)، "
+                    f"فشل {stats['failed']}، محظور {stats['forbidden']}، 429: {stats['retry_after']}، "
+                    f"مؤجلة لصالح الصلاة {stats['preempted']}"
+                )
+                continue
+            next_due_in = (await run_db(get_outbox_stats))['next_due_in']
+        except Exception as e:
+            logger.error(f"❌ خطأ في عامل صندوق الصادر: {e}")
+            next_due_in = None
+        wait = OUTBOX_POLL_INTERVAL if next_due_in is None else min(next_due_in, OUTBOX_POLL_INTERVAL)
+        try:
+            await asyncio.wait_for(_outbox_wakeup.wait(), timeout=max(wait, 0.05))
+        except asyncio.TimeoutError:
+            pass
+    logger.info("✅ تم إيقاف عامل صندوق الصادر")
+
+def start_outbox_worker(application: Application):
+    """تشغيل عامل صندوق الصادر كمهمة في الخلفية"""
+    global _outbox_task
+    if _outbox_task is None:
+        _outbox_stopping.clear()
+        _outbox_task = asyncio.create_task(outbox_worker(application))
+
+async def stop_outbox_worker(timeout: float = 30):
+    """إيقاف العامل بعد إنهاء الدفعة الجارية وتسجيلها"""
+    global _outbox_task
+    if _outbox_task is None:
+        return
+    _outbox_stopping.set()
+    _outbox_wakeup.set()
+    try:
+        await asyncio.wait_for(_outbox_task, timeout=timeout)
+    except asyncio.TimeoutError:
+        logger.warning("⚠️ انتهت مهلة إيقاف عامل صندوق الصادر؛ ستُستأنف الدفعة المحجوزة بعد انتهاء الحجز")
+        _outbox_task.cancel()
+    _outbox_task = None
+
+# ==================== دوال الجدولة ====================
+def damascus_now():
+    """الوقت الحالي بتوقيت دمشق بغض النظر عن توقيت الخادم"""
+    return datetime.datetime.now(BOT_TIMEZONE)
+
+def broadcast_key(name, day=None):
+    """مفتاح البث اليومي المستخدم لمنع تكرار إدراجه في صندوق الصادر"""
+    return f"{name}:{(day or damascus_now().date()):%Y%m%d}"
+
+def build_prayer_messages(prayer_name: str, city_name_ar: str):
+    """رسائل إشعار الصلاة: الأذان ثم ذكر بعد الصلاة"""
+    return [
+        f"🕋 <b>الله أكبر، الله أكبر.</b> حان الآن وقت صلاة <b>{prayer_name}</b> في محافظة <b>{city_name_ar}</b>.",
+        random.choice(AZKAR_AFTER_PRAYER)
+    ]
+
+async def send_city_prayer_notification(application: Application, city_en: str, prayer_name: str):
+    """إرسال إشعار الصلاة لجميع المشتركين الحاليين في المدينة"""
+    user_ids = get_indexed_city_subscribers(city_en)
+    if not user_ids:
+        return
+    city_name_ar = CITY_AR_BY_EN[city_en]
+    deliveries = [(user_id, build_prayer_messages(prayer_name, city_name_ar)) for user_id in user_ids]
+    await enqueue_broadcast(
+        deliveries,
+        f"صلاة {prayer_name} - {city_name_ar}",
+        broadcast_key(f"prayer:{city_en}:{prayer_name}"),
+        followup_delay=3,
+        priorities=(SEND_PRIORITY_PRAYER, SEND_PRIORITY_AFTER_PRAYER)
+    )
 
 async def send_static_content(application: Application, content_list: list, content_type: str):
     if not content_list:
         return
-    users = get_premium_users()
+    users = get_indexed_premium_users()
     if not users:
         return
     message = random.choice(content_list)
-    for user_id, _ in users:
-        try:
-            await application.bot.send_message(chat_id=user_id, text=message, parse_mode='HTML')
-        except Exception:
-            pass
+    await enqueue_broadcast(
+        [(user_id, [message]) for user_id, _ in users],
+        content_type,
+        broadcast_key(f"static:{content_type}")
+    )
 
 async def send_daily_varied_azkar(application: Application):
-    users = get_premium_users()
+    users = get_indexed_premium_users()
     if not users:
         return
     
@@ -873,37 +2451,109 @@ async def send_daily_varied_azkar(application: Application):
     selected_type = random.choice(azkar_types)
     message = random.choice(selected_type)
     
-    for user_id, _ in users:
-        try:
-            await application.bot.send_message(chat_id=user_id, text=message, parse_mode='HTML')
-        except Exception as e:
-            logger.error(f"❌ فشل إرسال أذكار متنوعة للمستخدم {user_id}: {e}")
+    await enqueue_broadcast(
+        [(user_id, [message]) for user_id, _ in users],
+        "أذكار متنوعة",
+        broadcast_key("varied_azkar")
+    )
 
 async def send_weather_reports(application: Application):
-    users = get_premium_users()
-    if not users:
+    city_ens = [city_en for city_en in SYRIAN_CITIES.values() if get_indexed_city_subscribers(city_en)]
+    if not city_ens:
         return
-    for user_id, city_url in users:
-        if not city_url:
-            continue
+    
+    reports = await asyncio.gather(*(get_weather_data(city_en) for city_en in city_ens))
+    
+    deliveries = [
+        (user_id, [weather_report, random.choice(DEFAULT_SUPPLICATIONS)])
+        for city_en, weather_report in zip(city_ens, reports)
+        for user_id in get_indexed_city_subscribers(city_en)
+    ]
+    await enqueue_broadcast(deliveries, "تقارير الطقس", broadcast_key("weather"), followup_delay=2)
+
+async def fetch_city_calendar(semaphore: asyncio.Semaphore, city_en: str, year: int, month: int):
+    """جلب مواقيت شهر كامل لمدينة واحدة بطلب واحد"""
+    async with semaphore:
+        response = await http_get(
+            BASE_PRAYER_CALENDAR_API.format(city_en=city_en, year=year, month=month),
+            timeout=15
+        )
+    days = []
+    for entry in response.json().get('data', []):
+        day = datetime.datetime.strptime(entry['date']['gregorian']['date'], "%d-%m-%Y").date()
+        timings = {key: entry['timings'][key].split()[0] for key in PRAYER_KEYS}
+        days.append((day, timings))
+    return days
+
+def months_between(start: datetime.date, end: datetime.date):
+    """كل الأشهر (السنة، الشهر) من start إلى end شاملة"""
+    months = []
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        months.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+async def refresh_prayer_calendar(city_ens=None):
+    """تعبئة جدول المواقيت للأيام الثلاثين القادمة للمدن الناقصة فقط"""
+    if PRAYER_TIMES_SOURCE == 'local':
+        return
+    today = damascus_now().date()
+    end = today + datetime.timedelta(days=PRAYER_CACHE_DAYS)
+    months = months_between(today, end)
+    
+    coverage = await run_db(get_prayer_cache_coverage, today, end)
+    city_ens = [
+        city_en for city_en in (city_ens or SYRIAN_CITIES.values())
+        if coverage.get(city_en, 0) < PRAYER_CACHE_DAYS + 1
+    ]
+    if not city_ens:
+        return
+    
+    semaphore = asyncio.Semaphore(PRAYER_FETCH_CONCURRENCY)
+    
+    async def refresh_city_month(city_en, year, month):
         try:
-            city_en = get_city_en_from_url(city_url)
-            weather_report = get_weather_data(city_en)
-            await application.bot.send_message(chat_id=user_id, text=weather_report, parse_mode='HTML')
-            
-            await asyncio.sleep(2)
-            supplication = random.choice(DEFAULT_SUPPLICATIONS)
-            await application.bot.send_message(chat_id=user_id, text=supplication, parse_mode='HTML')
-            
+            days = await fetch_city_calendar(semaphore, city_en, year, month)
+            return await run_db(save_prayer_calendar, city_en, days)
         except Exception as e:
-            logger.error(f"❌ فشل إرسال تقرير الطقس للمستخدم {user_id}: {e}")
+            logger.error(f"❌ فشل تحديث تقويم الصلاة لـ {city_en} ({year}-{month:02d}): {e}")
+            return 0
+    
+    saved = await asyncio.gather(
+        *(refresh_city_month(city_en, year, month) for city_en in city_ens for year, month in months)
+    )
+    purged = await run_db(purge_old_prayer_times, today - datetime.timedelta(days=PRAYER_CACHE_MAX_STALE_DAYS))
+    logger.info(f"🗓️ تم تحديث تقويم الصلاة: {sum(saved)} يوم لـ {len(city_ens)} مدينة، حذف {purged} يوم قديم")
+
+async def resolve_city_timings(city_ens, day: datetime.date):
+    """قراءة مواقيت كل مدينة من الجدول المحلي، مع آخر بيانات معروفة أو الحساب المحلي عند تعذر الـ API"""
+    if PRAYER_TIMES_SOURCE == 'local':
+        return {city_en: get_offline_timings(city_en, day) for city_en in city_ens}
+    
+    cached = await run_db(get_cached_timings, day)
+    missing = [city_en for city_en in city_ens if city_en not in cached]
+    if missing:
+        await refresh_prayer_calendar(missing)
+        cached = await run_db(get_cached_timings, day)
+    
+    timings_by_city = {}
+    for city_en in city_ens:
+        times_data = cached.get(city_en)
+        if not times_data:
+            times_data = await run_db(get_last_known_timings, city_en, day)
+            if times_data:
+                logger.warning(f"⚠️ استخدام آخر مواقيت معروفة لـ {city_en}")
+        if not times_data:
+            logger.warning(f"⚠️ استخدام المواقيت المحسوبة محلياً لـ {city_en}")
+            times_data = get_offline_timings(city_en, day)
+        timings_by_city[city_en] = times_data
+    return timings_by_city
 
 async def schedule_daily_prayer_notifications(application: Application):
     logger.info("🔄 جدولة إشعارات الصلاة اليومية")
-    current_date = datetime.datetime.now().date()
-    users_data = get_premium_users()
-    if not users_data:
-        return
+    now = damascus_now()
+    current_date = now.date()
     
     PRAYER_FIELDS = {
         "الفجر": 'Fajr',
@@ -914,98 +2564,139 @@ async def schedule_daily_prayer_notifications(application: Application):
     }
     
     scheduler = application.bot_data.get('scheduler')
+    timings_by_city = await resolve_city_timings(list(SYRIAN_CITIES.values()), current_date)
     
-    for user_id, city_url in users_data:
-        if not city_url:
+    jobs_count = 0
+    caught_up = 0
+    for city_en, times_data in timings_by_city.items():
+        if not times_data:
             continue
-        try:
-            response = requests.get(city_url, timeout=10)
-            times_data = response.json().get('data', {}).get('timings')
-            if not times_data:
+        for prayer_name_ar, prayer_key_en in PRAYER_FIELDS.items():
+            time_str = times_data.get(prayer_key_en)
+            if not time_str:
                 continue
-            city_name_ar = get_city_ar_from_url(city_url)
-            for prayer_name_ar, prayer_key_en in PRAYER_FIELDS.items():
-                time_str = times_data.get(prayer_key_en)
-                if time_str:
-                    try:
-                        hour, minute = map(int, time_str.split(':'))
-                        run_datetime = datetime.datetime(
-                            current_date.year,
-                            current_date.month,
-                            current_date.day,
-                            hour,
-                            minute,
-                            0
-                        )
-                        if run_datetime > datetime.datetime.now():
-                            job_id = f"prayer_{user_id}_{prayer_key_en}_{current_date.strftime('%Y%m%d')}"
-                            scheduler.add_job(
-                                send_single_prayer_notification,
-                                'date',
-                                run_date=run_datetime,
-                                args=[application, user_id, prayer_name_ar, city_name_ar],
-                                id=job_id
-                            )
-                    except:
-                        pass
-        except Exception as e:
-            logger.error(f"❌ خطأ في جدولة الصلوات للمستخدم {user_id}: {e}")
+            try:
+                hour, minute = map(int, time_str.split(':'))
+                run_datetime = datetime.datetime(
+                    current_date.year,
+                    current_date.month,
+                    current_date.day,
+                    hour,
+                    minute,
+                    0,
+                    tzinfo=BOT_TIMEZONE
+                )
+                if run_datetime <= now:
+                    # وقت صلاة فات أثناء إعادة التشغيل: إرسالها فوراً ضمن مهلة التأخير، ومفتاح البث يمنع التكرار
+                    if (now - run_datetime).total_seconds() > PRAYER_MISFIRE_GRACE:
+                        continue
+                    run_datetime = now
+                    caught_up += 1
+                job_id = f"prayer_{city_en}_{prayer_key_en}_{current_date.strftime('%Y%m%d')}"
+                scheduler.add_job(
+                    send_city_prayer_notification,
+                    'date',
+                    run_date=run_datetime,
+                    args=[application, city_en, prayer_name_ar],
+                    id=job_id,
+                    replace_existing=True,
+                    misfire_grace_time=PRAYER_MISFIRE_GRACE
+                )
+                jobs_count += 1
+            except Exception as e:
+                logger.error(f"❌ خطأ في جدولة صلاة {prayer_key_en} لـ {city_en}: {e}")
+    
+    logger.info(f"🕌 تم جدولة {jobs_count} مهمة صلاة لـ {len(timings_by_city)} مدينة ({caught_up} متأخرة)")
+    return jobs_count
+
+def daily_content_jobs(application: Application):
+    """المهام اليومية الثابتة: (المعرف، الساعة، الدقيقة، الدالة، الوسائط، اسم البث أو None)"""
+    return [
+        ('azkar_sabah_daily', 6, 30, send_static_content, [application, AZKAR_SABAH_LIST, "أذكار الصباح"], "static:أذكار الصباح"),
+        ('weather_prewarm_daily', 7, 55, prewarm_weather_cache, [], None),
+        ('weather_reports_daily', 8, 0, send_weather_reports, [application], "weather"),
+        ('azkar_dhuhr_daily', 13, 0, send_static_content, [application, AZKAR_DHUHR_LIST, "أذكار الظهر"], "static:أذكار الظهر"),
+        ('varied_azkar_daily', 15, 0, send_daily_varied_azkar, [application], "varied_azkar"),
+    ]
 
 async def schedule_daily_tasks(application: Application):
+    """جدولة المهام اليومية وتشغيل ما فات منها اليوم ولم يُدرج بعد في صندوق الصادر"""
     scheduler = application.bot_data.get('scheduler')
+    now = damascus_now()
+    caught_up = 0
     
-    scheduler.add_job(
-        lambda: send_static_content(application, AZKAR_SABAH_LIST, "أذكار الصباح"),
-        'cron',
-        hour=6,
-        minute=30,
-        timezone='Asia/Damascus',
-        id='azkar_sabah_daily'
-    )
+    for job_id, hour, minute, func, args, broadcast_name in daily_content_jobs(application):
+        scheduler.add_job(
+            func,
+            'cron',
+            hour=hour,
+            minute=minute,
+            args=args,
+            timezone='Asia/Damascus',
+            id=job_id,
+            replace_existing=True
+        )
+        if broadcast_name is None:
+            continue
+        due = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if not 0 <= (now - due).total_seconds() <= CONTENT_CATCHUP_MINUTES * 60:
+            continue
+        if await run_db(is_broadcast_enqueued, broadcast_key(broadcast_name)):
+            continue
+        scheduler.add_job(func, 'date', args=args, id=f"{job_id}_catchup", replace_existing=True)
+        caught_up += 1
     
-    scheduler.add_job(
-        send_weather_reports,
-        'cron',
-        hour=8,
-        minute=0,
-        args=[application],
-        timezone='Asia/Damascus',
-        id='weather_reports_daily'
-    )
+    logger.info(f"✅ تم جدولة المهام اليومية ({caught_up} مهمة فائتة ستُرسل الآن)")
+
+async def warm_restart(application: Application):
+    """إعادة بناء جدول اليوم فور التشغيل من المواقيت المخزنة دون انتظار الساعة 01:00"""
+    started = time.monotonic()
+    await schedule_daily_tasks(application)
+    prayer_jobs = await schedule_daily_prayer_notifications(application)
+    logger.info(f"♻️ تمت استعادة جدول اليوم ({prayer_jobs} مهمة صلاة) خلال {time.monotonic() - started:.1f} ثانية")
+    await refresh_prayer_calendar()
+
+async def expire_subscriptions():
+    """إنهاء الاشتراكات المنتهية ثم إعادة بناء فهرس المشتركين إن تغير"""
+    if await run_db(check_expiry_and_update):
+        await run_db(load_premium_index)
+
+async def post_init_callback(application: Application):
+    logger.info("🚀 بدء تهيئة البوت")
+    await start_http_client()
+    start_db_executor()
+    await run_db(load_premium_index)
+    await run_db(load_dead_chats)
+    start_outbox_worker(application)
+    start_write_behind()
+    
+    scheduler = AsyncIOScheduler(timezone='Asia/Damascus')
+    application.bot_data['scheduler'] = scheduler
     
     scheduler.add_job(
-        lambda: send_static_content(application, AZKAR_DHUHR_LIST, "أذكار الظهر"),
+        expire_subscriptions,
         'cron',
-        hour=13,
-        minute=0,
+        hour=0,
+        minute=5,
         timezone='Asia/Damascus',
-        id='azkar_dhuhr_daily'
+        id='check_expiry_daily'
     )
     
     scheduler.add_job(
-        send_daily_varied_azkar,
-        'cron',
-        hour=15,
-        minute=0,
-        args=[application],
-        timezone='Asia/Damascus',
-        id='varied_azkar_daily'
+        run_db,
+        'interval',
+        minutes=PREMIUM_INDEX_VERIFY_MINUTES,
+        args=[verify_premium_index],
+        id='verify_premium_index'
     )
     
-    logger.info("✅ تم جدولة المهام اليومية")
-
-async def post_init_callback(application: Application):
-    logger.info("🚀 بدء تهيئة البوت")
-    scheduler = AsyncIOScheduler(timezone='Asia/Damascus')
-    application.bot_data['scheduler'] = scheduler
-    
     scheduler.add_job(
-        check_expiry_and_update,
+        refresh_prayer_calendar,
         'cron',
         hour=0,
-        minute=5,
+        minute=30,
         timezone='Asia/Damascus',
-        id='check_expiry_daily'
+        id='refresh_prayer_calendar_daily'
     )
     
     scheduler.add_job(
@@ -1019,18 +2710,237 @@ async def post_init_callback(application: Application):
     )
     
     scheduler.add_job(
-        schedule_daily_tasks,
+        warm_restart,
         'date',
-        run_date=datetime.datetime.now() + datetime.timedelta(seconds=10),
         args=[application],
-        id='schedule_tasks_initial'
+        id='warm_restart'
     )
     
     scheduler.start()
     application.bot_data['scheduler_started'] = True
     logger.info("✅ تم بدء تشغيل Scheduler")
 
+async def post_stop_callback(application: Application):
+    await stop_outbox_worker()
+    await stop_write_behind()
+
+async def post_shutdown_callback(application: Application):
+    logger.info("🛑 إيقاف البوت")
+    await close_http_client()
+    shutdown_db_executor()
+    close_db_pool()
+
+# ==================== معالجة التحديثات المتزامنة ====================
+class PerUserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """معالجة التحديثات بالتوازي مع الحفاظ على ترتيب تحديثات المستخدم الواحد"""
+    
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._user_queues = {}
+        self.in_flight = 0
+        # التحديثات المستلمة التي لم تبدأ بعد: بانتظار خانة أو خلف تحديث آخر لنفس المستخدم
+        self.pending = 0
+        self.latencies = deque(maxlen=UPDATE_LATENCY_SAMPLES)
+    
+    async def process_update(self, update, coroutine):
+        """تحديثات كل مستخدم تُنفذ بالترتيب ضمن خانة واحدة من حد التزامن العام
+        
+        أول تحديث للمستخدم يحجز الخانة وينفذ ما يصل بعده لنفس المستخدم، فلا يحجز المستخدم
+        الواحد أكثر من خانة ولا تنتظر تحديثاته المتتالية دوراً جديداً في الطابور العام
+        """
+        user = update.effective_user if isinstance(update, Update) else None
+        started = time.monotonic()
+        self.pending += 1
+        if user is None:
+            try:
+                await self._semaphore.acquire()
+            finally:
+                self.pending -= 1
+            try:
+                await self.do_process_update(update, coroutine)
+            finally:
+                self._semaphore.release()
+                self.latencies.append(time.monotonic() - started)
+            return
+        
+        done = asyncio.get_running_loop().create_future()
+        queue = self._user_queues.get(user.id)
+        if queue is not None:
+            queue.append((update, coroutine, done, started))
+            await done
+            return
+        
+        queue = self._user_queues[user.id] = deque([(update, coroutine, done, started)])
+        try:
+            async with self._semaphore:
+                while queue:
+                    item_update, item_coroutine, item_done, item_started = queue[0]
+                    self.pending -= 1
+                    try:
+                        if item_done.cancelled():
+                            item_coroutine.close()
+                            continue
+                        await self.do_process_update(item_update, item_coroutine)
+                        if not item_done.done():
+                            item_done.set_result(None)
+                    except Exception as e:
+                        if not item_done.done():
+                            item_done.set_exception(e)
+                    finally:
+                        queue.popleft()
+                        if not item_done.done():
+                            item_done.cancel()
+                        self.latencies.append(time.monotonic() - item_started)
+        finally:
+            del self._user_queues[user.id]
+            # عند إلغاء المهمة المنفذة لا تبقى التحديثات المنتظرة معلقة
+            for _, item_coroutine, item_done, _ in queue:
+                self.pending -= 1
+                item_coroutine.close()
+                item_done.cancel()
+        await done
+    
+    async def do_process_update(self, update, coroutine):
+        self.in_flight += 1
+        try:
+            await coroutine
+        finally:
+            self.in_flight -= 1
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+    
+    def latency_percentiles(self):
+        """النسب المئوية لزمن معالجة التحديثات الأخيرة بالميلي ثانية"""
+        samples = sorted(self.latencies)
+        if not samples:
+            return None
+        
+        def pick(p):
+            return samples[min(len(samples) - 1, int(p / 100 * len(samples)))] * 1000
+        return {'p50': pick(50), 'p95': pick(95), 'p99': pick(99), 'count': len(samples)}
+
+_update_processor = PerUserOrderedUpdateProcessor(UPDATE_CONCURRENCY)
+
+def get_update_latency_line():
+    """سطر زمن معالجة التحديثات لتقرير الصحة"""
+    stats = _update_processor.latency_percentiles()
+    if not stats:
+        return "⏱️ <b>زمن المعالجة:</b> لا توجد بيانات"
+    return (
+        f"⏱️ <b>زمن المعالجة:</b> p50 {stats['p50']:.0f}ms، p95 {stats['p95']:.0f}ms، "
+        f"p99 {stats['p99']:.0f}ms ({_update_processor.in_flight} قيد المعالجة، "
+        f"{_update_processor.pending} بالانتظار)"
+    )
+
+# ==================== خادم Webhook ====================
+class TelegramWebhookHandler(RequestHandler):
+    """استلام تحديثات Telegram ووضعها في طابور التطبيق
+    
+    update_queue في PTB لا يمتلئ لأن كل تحديث يُسحب منه فوراً إلى مهمة مستقلة، لذا يُطبق
+    UPDATE_QUEUE_SIZE هنا على التحديثات المنتظرة فعلاً: عند بلوغه يُرد بـ 503 فيعيد Telegram الإرسال لاحقاً
+    """
+    
+    def initialize(self, bot_application):
+        self.bot_application = bot_application
+    
+    async def post(self):
+        backlog = _update_processor.pending + self.bot_application.update_queue.qsize()
+        if UPDATE_QUEUE_SIZE and backlog >= UPDATE_QUEUE_SIZE:
+            increment_counter('bot_webhook_rejected_total')
+            self.set_status(503)
+            return
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.bot_application.bot)
+        except ValueError:
+            self.set_status(400)
+            return
+        increment_counter('bot_webhook_updates_total')
+        await self.bot_application.update_queue.put(update)
+
+class MetricsHandler(RequestHandler):
+    """عرض المقاييس بصيغة Prometheus"""
+    
+    async def get(self):
+        try:
+            outbox_stats = await run_db(get_outbox_stats)
+        except Exception:
+            outbox_stats = None
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(render_metrics(outbox_stats))
+
+def _log_web_request(handler):
+    # رفض 503 عند امتلاء الطابور يُعد في bot_webhook_rejected_total ولا يُسجل لكل طلب
+    if handler.get_status() >= 400 and handler.get_status() != 503:
+        logger.warning(f"⚠️ طلب ويب فاشل {handler.request.method} {handler.get_status()}")
+
+def create_web_app(application: Application):
+    """تطبيق الويب: مسار webhook ومسار المقاييس على نفس المنفذ"""
+    return WebApplication(
+        [
+            (f"/{re.escape(TOKEN)}/?", TelegramWebhookHandler, {'bot_application': application}),
+            (re.escape(METRICS_PATH), MetricsHandler),
+        ],
+        log_function=_log_web_request
+    )
+
+async def run_webhook_server(application: Application):
+    """تشغيل البوت عبر webhook حتى استلام إشارة الإيقاف"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    await application.initialize()
+    await application.post_init(application)
+    await application.bot.set_webhook(
+        url=f"{WEBHOOK_URL}/{TOKEN}",
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        drop_pending_updates=True
+    )
+    await application.start()
+    server = HTTPServer(create_web_app(application))
+    server.listen(PORT, "0.0.0.0")
+    logger.info(f"✅ Webhook والمقاييس ({METRICS_PATH}) على المنفذ {PORT}")
+    try:
+        await stop_event.wait()
+    finally:
+        server.stop()
+        await application.stop()
+        await application.post_stop(application)
+        await application.shutdown()
+        await application.post_shutdown(application)
+
 # ==================== الدالة الرئيسية ====================
+def build_application():
+    """إنشاء تطبيق البوت وتسجيل جميع المعالجات"""
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .base_url(TELEGRAM_API_URL)
+        .post_init(post_init_callback)
+        .post_stop(post_stop_callback)
+        .post_shutdown(post_shutdown_callback)
+        .concurrent_updates(_update_processor)
+        .build()
+    )
+    
+    application.add_handler(TypeHandler(Update, throttle_update), group=-2)
+    application.add_handler(TypeHandler(Update, reactivate_dead_chat, block=False), group=-1)
+    application.add_handler(CommandHandler("start", start_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("weather", weather_command))
+    application.add_handler(CommandHandler("health", health_command))
+    application.add_handler(CommandHandler("admin", admin_command))
+    application.add_handler(CommandHandler("as", confirm_payment_command))
+    application.add_handler(CommandHandler("getfileid", get_file_id_command))
+    
+    application.add_handler(CallbackQueryHandler(unified_callback_handler))
+    return application
+
 def main():
     """الدالة الرئيسية لتشغيل البوت"""
     if not TOKEN or not OWNER_ID_STR or not WEBHOOK_URL:
@@ -1044,34 +2954,19 @@ def main():
         sys.exit(1)
     
     try:
+        init_db_pool()
         setup_db()
         logger.info("✅ تم إعداد قاعدة البيانات")
     except Exception as e:
         logger.error(f"❌ فشل إعداد قاعدة البيانات: {e}")
         sys.exit(1)
     
-    application = Application.builder().token(TOKEN).post_init(post_init_callback).build()
-    
-    application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(CommandHandler("stats", stats_command))
-    application.add_handler(CommandHandler("weather", weather_command))
-    application.add_handler(CommandHandler("health", health_command))
-    application.add_handler(CommandHandler("admin", admin_command))
-    application.add_handler(CommandHandler("as", confirm_payment_command))
-    application.add_handler(CommandHandler("getfileid", get_file_id_command))
-    
-    application.add_handler(CallbackQueryHandler(unified_callback_handler))
+    application = build_application()
     
     logger.info(f"🚀 بدء البوت على المنفذ {PORT}...")
     
     try:
-        application.run_webhook(
-            listen="0.0.0.0",
-            port=PORT,
-            url_path=TOKEN,
-            webhook_url=f"{WEBHOOK_URL}/{TOKEN}",
-            drop_pending_updates=True
-        )
+        asyncio.run(run_webhook_server(application))
     except Exception as e:
         logger.error(f"❌ فشل في تشغيل البوت: {e}")
         sys.exit(1)
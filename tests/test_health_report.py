@@ -0,0 +1,28 @@
+"""اختبار تقرير الصحة عند تعذر الوصول إلى قاعدة البيانات"""
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sy
+
+
+def test_health_report_without_stats_snapshot(monkeypatch, tmp_path):
+    def fail():
+        raise RuntimeError("db down")
+
+    monkeypatch.setattr(sy, "SQLITE_PATH", str(tmp_path / "health.db"))
+    monkeypatch.setattr(sy, "compute_stats_snapshot", fail)
+    monkeypatch.setitem(sy._stats_cache, "snapshot", None)
+    monkeypatch.setattr(sy, "_stats_lock", None)
+
+    async def build():
+        try:
+            return await sy.build_health_report()
+        finally:
+            sy.close_sqlite_connections()
+            sy.shutdown_db_executor()
+
+    report = asyncio.run(build())
+    assert "محادثات متوقفة" in report
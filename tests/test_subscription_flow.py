@@ -0,0 +1,82 @@
+"""اختبار مسار الاشتراك: اختيار المدينة ثم طلب التفعيل حتى وصول رقم الطلب إلى قاعدة البيانات"""
+import asyncio
+import os
+import sys
+from collections import OrderedDict, defaultdict
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sy
+
+
+class FakeQuery:
+    def __init__(self, user_id):
+        self.from_user = SimpleNamespace(id=user_id, username="tester", full_name="Test User")
+        self.texts = []
+
+    async def edit_message_text(self, text, **kwargs):
+        self.texts.append(text)
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, **kwargs):
+        self.sent.append(kwargs)
+
+
+def test_city_choice_and_order_reach_database(monkeypatch, tmp_path):
+    monkeypatch.setattr(sy, "SQLITE_PATH", str(tmp_path / "flow.db"))
+    monkeypatch.setattr(sy, "OWNER_ID_STR", "1")
+    monkeypatch.setattr(sy, "QR_CODE_IMAGE_FILE_ID", None)
+    monkeypatch.setattr(sy, "_pending_city_writes", {})
+    monkeypatch.setattr(sy, "_pending_order_writes", {})
+    monkeypatch.setattr(sy, "_session_cities", OrderedDict())
+    monkeypatch.setattr(sy, "_write_behind_lock", asyncio.Lock())
+
+    user_id = 42
+    bot = FakeBot()
+    context = SimpleNamespace(bot=bot)
+
+    async def flow():
+        try:
+            await sy.run_db(sy.setup_db)
+            query = FakeQuery(user_id)
+            await sy.handle_city_choice(query, "CITY_CHOICE_Damascus", user_id)
+            await sy.handle_activate_order(query, user_id, context)
+            order_id = sy._pending_order_writes[user_id]
+            assert await sy.flush_write_behind()
+
+            return (
+                query.texts,
+                order_id,
+                await sy.run_db(sy.get_user_by_order, order_id),
+                await sy.run_db(sy.get_user_city, user_id),
+            )
+        finally:
+            sy.close_sqlite_connections()
+            sy.shutdown_db_executor()
+
+    texts, order_id, order_user, city_code = asyncio.run(flow())
+    assert "تم إنشاء طلبك بنجاح" in texts[-1]
+    assert order_id in texts[-1]
+    assert order_user == user_id
+    assert city_code == sy.CITY_CODES["Damascus"]
+    assert len(bot.sent) == 1
+
+
+def test_premium_city_change_moves_index(monkeypatch):
+    monkeypatch.setattr(sy, "_pending_city_writes", {})
+    monkeypatch.setattr(sy, "_session_cities", OrderedDict())
+    monkeypatch.setattr(sy, "_premium_user_city", {})
+    monkeypatch.setattr(sy, "_premium_by_city", defaultdict(set))
+    premium_id = 43
+    sy.add_to_premium_index(premium_id, "Damascus")
+
+    asyncio.run(sy.handle_city_choice(FakeQuery(premium_id), "CITY_CHOICE_Aleppo", premium_id))
+
+    assert sy._pending_city_writes[premium_id] == sy.CITY_CODES["Aleppo"]
+    assert sy.get_indexed_city_subscribers("Aleppo") == [premium_id]
+    assert sy.get_indexed_city_subscribers("Damascus") == []
@@ -0,0 +1,102 @@
+"""اختبار معالج التحديثات: ترتيب تحديثات المستخدم الواحد دون تعطيل المستخدمين الآخرين"""
+import asyncio
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Chat, Message, Update, User
+
+import sy
+
+
+def make_update(update_id, user_id):
+    user = User(id=user_id, first_name="test", is_bot=False)
+    message = Message(
+        message_id=update_id,
+        date=datetime.datetime.now(datetime.timezone.utc),
+        chat=Chat(id=user_id, type=Chat.PRIVATE),
+        from_user=user,
+        text="/weather",
+    )
+    return Update(update_id=update_id, message=message)
+
+
+def test_flooding_user_does_not_hold_global_slots():
+    async def scenario():
+        processor = sy.PerUserOrderedUpdateProcessor(4)
+        order = []
+        finished = {}
+
+        async def handler(name, seconds):
+            await asyncio.sleep(seconds)
+            order.append(name)
+            finished[name] = time.monotonic()
+
+        started = time.monotonic()
+        tasks = [
+            asyncio.create_task(processor.process_update(make_update(i, 1), handler(f"a{i}", 0.2)))
+            for i in range(6)
+        ]
+        await asyncio.sleep(0.01)
+        tasks.append(asyncio.create_task(processor.process_update(make_update(100, 2), handler("b", 0.01))))
+        await asyncio.gather(*tasks)
+        return order, finished["b"] - started
+
+    order, b_elapsed = asyncio.run(scenario())
+    assert [name for name in order if name.startswith("a")] == [f"a{i}" for i in range(6)]
+    assert b_elapsed < 0.15
+
+
+def test_failed_update_does_not_block_users_queue():
+    async def scenario():
+        processor = sy.PerUserOrderedUpdateProcessor(2)
+        order = []
+
+        async def handler(name, fail=False):
+            await asyncio.sleep(0.01)
+            if fail:
+                raise RuntimeError(name)
+            order.append(name)
+
+        results = await asyncio.gather(
+            processor.process_update(make_update(1, 1), handler("first", fail=True)),
+            processor.process_update(make_update(2, 1), handler("second")),
+            processor.process_update(make_update(3, 1), handler("third")),
+            return_exceptions=True,
+        )
+        return order, results, processor._user_queues
+
+    order, results, queues = asyncio.run(scenario())
+    assert order == ["second", "third"]
+    assert isinstance(results[0], RuntimeError) and results[1:] == [None, None]
+    assert queues == {}
+
+
+def test_pending_counts_updates_not_yet_started():
+    async def scenario():
+        processor = sy.PerUserOrderedUpdateProcessor(1)
+
+        async def handler():
+            await asyncio.sleep(0.05)
+
+        tasks = [asyncio.create_task(processor.process_update(make_update(i, 1), handler())) for i in range(3)]
+        tasks.append(asyncio.create_task(processor.process_update(make_update(10, 2), handler())))
+        await asyncio.sleep(0.01)
+        during = (processor.in_flight, processor.pending)
+        await asyncio.gather(*tasks)
+        after = processor.pending
+
+        tasks = [asyncio.create_task(processor.process_update(make_update(20 + i, 3), handler())) for i in range(3)]
+        await asyncio.sleep(0.01)
+        tasks[0].cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return during, after, processor.pending, processor._user_queues
+
+    during, after, after_cancel, queues = asyncio.run(scenario())
+    assert during == (1, 3)
+    assert after == 0
+    assert after_cancel == 0
+    assert queues == {}